@@ -1,23 +1,48 @@
 import requests
 import json
-import pandas as pd
 import argparse
 import datetime
-from dateutil import tz
+import importlib
 import os
-import matplotlib
-import matplotlib.pyplot as plt
+import sys
+import time
+import threading
+import traceback
+import concurrent.futures
+from ardiapi import LazyImport, TrimFrame, AQLQuery, AQLHistRequest, AQLResult
 #import templateblock
 
+pd = LazyImport("pandas")
+tz = LazyImport("dateutil.tz")
+
+#matplotlib and pyplot are only imported when a report actually asks for them (ie. aql.plt)
+def __getattr__(name):
+    if name == 'matplotlib':
+        return importlib.import_module('matplotlib')
+    if name == 'plt':
+        return importlib.import_module('matplotlib.pyplot')
+    raise AttributeError("module 'aql' has no attribute '" + name + "'")
+
 global commonsettings
 commonsettings = {}
 commonsettings['supportcount'] = 149
 commonsettings['mgoffset'] = 10
 commonsettings['tgoffset'] = 10
 
-def query(server,qry):
+#Connections are kept open and shared between queries
+_http = None
+
+def _session():
+    global _http
+    if _http is None:
+        _http = requests.Session()
+    return _http
+
+def query(server,qry,session=None):
     #print("Requesting..." + "http://" + server + "/api/aql/query?query=" + qry)
-    req = requests.post("http://" + server + "/api/aql/query",{ "query": qry })    
+    if session is None:
+        session = _session()
+    req = session.post("http://" + server + "/api/aql/query",{ "query": qry })    
     content = req.text
     #print(content)
     return json.loads(content)
@@ -40,54 +65,15 @@ def ConvertTZ(dt, fromtz, totz):
     return local.astimezone(totz).strftime('%Y-%m-%d %H:%M:%S')
 
 def TrimDataFrame(df,start,end):
-    try:        
-        stpnt = df.index.get_loc(start,method='pad')
-        enpnt = df.index.get_loc(end,method='backfill')
-    except:
+    if not df.index.is_unique:
         df = df[~df.index.duplicated(keep='first')]
-        try:
-            stpnt = df.index.get_loc(start,method='pad')
-            enpnt = df.index.get_loc(end,method='backfill')
-        except:
-            return df
-    dfx = df[start:end]
-
-    pre = None
     try:
-        pre = df[:start].fillna(method='ffill')
+        return TrimFrame(df,start,end,hold=True)
     except:
-        pass
-    
-    print("Closest Start Index = " + str(stpnt) + " = " + str(df.index[stpnt]) + ' vs ' + str(start))
-    if df.index[stpnt] < start:
-        print("Appending Start Value...")
-        if pre is not None and len(pre) > 0:
-            newdata = [pre.iloc[len(pre)-1].values]
-        else:
-            newdata = [df.iloc[stpnt].values]
-        newindex = [start]
-        tdf = pd.DataFrame(data=newdata,columns=dfx.columns,index=newindex)
-        dfx = pd.concat([tdf,dfx])
-    else:
-        if pre is not None and len(pre) > 0:
-            print("Filling In Start Values...")
-            for n in pre.columns:            
-                dfx.iloc[0][n] = pre.iloc[len(pre)-1][n]            
-            pass
-    
-    
-    #print("Closest End Index = " + str(enpnt) + " = " + str(df.index[enpnt]) + ' vs ' + str(end))
-    if df.index[enpnt] > end:
-        print("Padding End Value...")
-        newdata = [df.iloc[enpnt].values]
-        newindex = [end]
-        tdf = pd.DataFrame(data=newdata,columns=dfx.columns,index=newindex)
-        dfx = pd.concat([dfx,tdf])
-        #print(str(dfx))
-    
-    return dfx    
+        return df
 
-def ReportArgs(name):
+#Argv can be given to parse a report's arguments from a list rather than the command line
+def ReportArgs(name,argv=None):
     deftz = "Australia/Sydney"
     defserver = "localhost/s/default"
     defname = "ARDI Server"
@@ -118,7 +104,7 @@ def ReportArgs(name):
     parser.add_argument('--nopng',dest='nopng',action='store_const',const=True,default=False)
     parser.add_argument('--server',dest='server',default=defserver)
     parser.add_argument('--param',dest='param',default=None)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     args.local_zone = tz.gettz(args.timezone)
     args.server_zone = tz.gettz('UTC')    
@@ -234,3 +220,162 @@ def historyToDataFrame(results,namemap=None,report=None,mapna=None):
         return pointlistToDataFrame(results)
     
     return final
+
+#Runs many reports in one process. Reports are functions called with (args,batch) - they get their data from
+# batch.History, which shares fetched and decoded history between reports asking for the same query over
+# overlapping times, and draw plots with batch.Plot, which uses a non-interactive backend.
+#
+#   batch = ReportBatch()
+#   batch.Add("Daily Flow",dailyflow,["2024-01-01 00:00:00","2024-01-02 00:00:00","out/","Australia/Sydney"],
+#             queries=["'Pump' ASSET 'Flow' PROPERTY VALUES {} GETHISTORY"])
+#   results = batch.Run()
+class ReportBatch:
+    def __init__(self,workers=1):
+        self.workers = workers
+        self.reports = []
+        self.http = requests.Session()
+
+        #Fetched history - (server, query, mode, samples, span) -> list of [start, end, results]
+        self.fetched = {}
+        self.lock = threading.Lock()
+        self.fetches = 0
+        self.shared = 0
+
+        #Pyplot's figures are shared by every thread, so reports that plot take turns
+        self.plotlock = threading.Lock()
+        self.local = threading.local()
+
+    #Add a report. Args is either a list of command-line arguments or an already parsed ReportArgs.
+    #Queries optionally lists the history queries the report will ask for, so they can be fetched together up front.
+    def Add(self,name,function,args,queries=None,mode="raw",samples=None,span=None):
+        if isinstance(args,list):
+            args = ReportArgs(name,args)
+        self.reports.append({'name': name,'function': function,'args': args,'queries': queries or [],'mode': mode,'samples': samples,'span': span})
+
+    #Run every report, returning a dictionary of name -> (result, error, seconds)
+    def Run(self):
+        self._prefetch()
+
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [(r['name'],pool.submit(self._run,r)) for r in self.reports]
+            for name, future in futures:
+                results[name] = future.result()
+        return results
+
+    #Get the history for a query (with a {} parameter block) over the report's time range, as a data frame in the report's local time.
+    #Raw history, or history at a fixed span, is cut from any fetched range that covers it.
+    def History(self,args,qry,mode="raw",samples=None,span=None,namemap=None,mapbad=None,mapna=None,autofill=True):
+        key = (args.server,qry,mode,samples,span)
+        start = args.utcstart.replace(tzinfo=None)
+        end = args.utcend.replace(tzinfo=None)
+
+        results = None
+        with self.lock:
+            for entry in self.fetched.get(key,[]):
+                if entry[0] <= start and entry[1] >= end and (entry[0] == start and entry[1] == end or self._shareable(mode,span)):
+                    results = entry[2]
+                    self.shared += 1
+                    break
+
+        if results is None:
+            results = self._fetch(key,start,end)
+
+        frame = AQLQuery(None).HistoryToDataframe(results,namemap=namemap,serverzone=args.server_zone,localzone=args.local_zone,mapbad=mapbad,mapna=mapna,autofill=autofill,trim=None)
+        if frame is None or len(frame.columns) == 0:
+            return frame
+        return TrimDataFrame(frame,args.localstart.replace(tzinfo=None),args.localend.replace(tzinfo=None))
+
+    #Return matplotlib's pyplot, set up to draw without a display. Matplotlib is only loaded by reports that plot.
+    #The report then has pyplot to itself until it finishes, and the figures it opens are closed afterwards.
+    def Plot(self):
+        with self.lock:
+            matplotlib = importlib.import_module('matplotlib')
+            if matplotlib.get_backend().lower() != 'agg':
+                matplotlib.use('Agg')
+            pyplot = importlib.import_module('matplotlib.pyplot')
+
+        if getattr(self.local,'figures',None) is None:
+            self.plotlock.acquire()
+            self.local.figures = set(pyplot.get_fignums())
+        return pyplot
+
+    #Internal: Run a single report
+    def _run(self,report):
+        start = time.perf_counter()
+        try:
+            result = report['function'](report['args'],self)
+            error = None
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            traceback.print_exc()
+            result = None
+            error = str(sys.exc_info()[1])
+        finally:
+            self._release()
+        return (result,error,time.perf_counter() - start)
+
+    #Internal: Close the figures opened by a report that plotted, and let the next one plot
+    def _release(self):
+        figures = getattr(self.local,'figures',None)
+        if figures is None:
+            return
+        self.local.figures = None
+        try:
+            pyplot = sys.modules['matplotlib.pyplot']
+            for num in pyplot.get_fignums():
+                if num not in figures:
+                    pyplot.close(num)
+        finally:
+            self.plotlock.release()
+
+    #Internal: True if a subset of a fetch can be used - interpolated data depends on the whole range requested
+    def _shareable(self,mode,span):
+        return mode == "raw" or span is not None
+
+    #Internal: Fetch the history for a query over a UTC time range
+    def _fetch(self,key,start,end):
+        server, qry, mode, samples, span = key
+        req = AQLHistRequest(qry)
+        req.SetRange(start,end)
+        req.mode = mode
+        req.samples = samples
+        req.span = span
+        results = AQLResult(query(server,req.Plan().Requests(req)[0][1],self.http))
+        with self.lock:
+            self.fetches += 1
+            self.fetched.setdefault(key,[]).append([start,end,results])
+        return results
+
+    #Internal: Fetch the declared queries for all reports, joining overlapping time ranges into a single request
+    def _prefetch(self):
+        ranges = {}
+        for r in self.reports:
+            args = r['args']
+            for qry in r['queries']:
+                key = (args.server,qry,r['mode'],r['samples'],r['span'])
+                ranges.setdefault(key,[]).append([args.utcstart.replace(tzinfo=None),args.utcend.replace(tzinfo=None)])
+
+        jobs = []
+        for key in ranges:
+            spans = sorted(set(tuple(x) for x in ranges[key]))
+            if not self._shareable(key[2],key[4]):
+                jobs.extend([(key,x[0],x[1]) for x in spans])
+                continue
+            merged = [list(spans[0])]
+            for st, en in spans[1:]:
+                if st <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1],en)
+                else:
+                    merged.append([st,en])
+            jobs.extend([(key,x[0],x[1]) for x in merged])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(self.workers,4)) as pool:
+            for future in [pool.submit(self._fetch,*job) for job in jobs]:
+                try:
+                    future.result()
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    print("WARNING: Unable to fetch report history - " + str(sys.exc_info()[1]))
@@ -1,19 +1,402 @@
 import requests
-import xmltodict
-import pandas as pd
-import numpy as np
 import json
+import bisect
+import importlib
 import traceback
 import time
-from dateutil import tz
 import datetime
-import pytz
+import threading
+import collections
+import logging
+import os
+import sys
+import copy
+import concurrent.futures
+from multiprocessing import shared_memory, resource_tracker
+
+#A module that is only imported the first time one of its attributes is used. The DataFrame, XML and timezone
+# libraries are slow to import and aren't needed by live-only clients, so they are loaded on demand.
+class LazyImport:
+    def __init__(self,name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self,attr):
+        return getattr(self._load(),attr)
+
+    def __setattr__(self,attr,value):
+        setattr(self._load(),attr,value)
+
+    def __repr__(self):
+        return "<lazy module '" + self.__dict__['_name'] + "'>"
+
+xmltodict = LazyImport("xmltodict")
+pd = LazyImport("pandas")
+np = LazyImport("numpy")
+tz = LazyImport("dateutil.tz")
+pytz = LazyImport("pytz")
 
 try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
 
+#A single request that is currently being made to the server, shared by every thread asking for the same thing
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+#A short-lived, least-recently-used cache of query results.
+# Identical requests made at the same time share a single request to the server (single-flight).
+class QueryCache:
+    def __init__(self,ttl=5,size=128):
+        #How long (in seconds) a result stays valid. 0 only shares requests that are in flight.
+        self.ttl = ttl
+
+        #The maximum number of results to keep
+        self.size = size
+
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    #Get a result from the cache, calling 'fetch' if it isn't available (or isn't already being fetched)
+    def Get(self,key,fetch):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.inflight[key] = flight
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if leader == False:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            flight.error = e
+            with self.lock:
+                del self.inflight[key]
+            flight.event.set()
+            raise
+
+        flight.value = value
+        with self.lock:
+            del self.inflight[key]
+            if self.ttl > 0:
+                self.entries[key] = (time.monotonic() + self.ttl,value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        flight.event.set()
+        return value
+
+    #Remove all cached results
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+
+#Receives timings from the library. This base class ignores them - sub-class it (or use LoggingInstrumentation
+# or MetricsInstrumentation) to see where time is being spent.
+class Instrumentation:
+    #Called after every HTTP request with the time taken and the size of the response
+    def Call(self,name,seconds,nbytes,ok=True):
+        pass
+
+    #Called after each processing stage (ie. parse, decode, tz, merge, fill, trim)
+    def Stage(self,name,seconds):
+        pass
+
+#Writes every timing to the Python log
+class LoggingInstrumentation(Instrumentation):
+    def __init__(self,logger=None,level=logging.INFO):
+        self.logger = logger
+        if self.logger is None:
+            self.logger = logging.getLogger("ardiapi")
+        self.level = level
+
+    def Call(self,name,seconds,nbytes,ok=True):
+        if ok == True:
+            self.logger.log(self.level,"ARDI call %s took %.4fs (%d bytes)",name,seconds,nbytes)
+        else:
+            self.logger.log(self.level,"ARDI call %s failed after %.4fs",name,seconds)
+
+    def Stage(self,name,seconds):
+        self.logger.log(self.level,"ARDI stage %s took %.4fs",name,seconds)
+
+#Totals timings in memory so they can be exported in the Prometheus text format
+class MetricsInstrumentation(Instrumentation):
+    def __init__(self,prefix="ardi"):
+        self.prefix = prefix
+        self.calls = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def Call(self,name,seconds,nbytes,ok=True):
+        with self.lock:
+            if name not in self.calls:
+                self.calls[name] = [0,0,0.0,0]
+            c = self.calls[name]
+            c[0] += 1
+            if ok == False:
+                c[1] += 1
+            c[2] += seconds
+            c[3] += nbytes
+
+    def Stage(self,name,seconds):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = [0,0.0]
+            st = self.stages[name]
+            st[0] += 1
+            st[1] += seconds
+
+    #Clear all of the totals
+    def Reset(self):
+        with self.lock:
+            self.calls = {}
+            self.stages = {}
+
+    #Returns the totals as Prometheus exposition text
+    def Export(self):
+        lines = []
+        with self.lock:
+            calls = sorted(self.calls.items())
+            stages = sorted(self.stages.items())
+
+        metrics = [("call_total","counter","calls",0),("call_errors_total","counter","calls",1),("call_seconds_total","counter","calls",2),("call_bytes_total","counter","calls",3)]
+        for name, kind, _, col in metrics:
+            lines.append("# TYPE " + self.prefix + "_" + name + " " + kind)
+            for call, vals in calls:
+                lines.append(self.prefix + "_" + name + '{call="' + call + '"} ' + repr(vals[col]))
+
+        metrics = [("stage_total","counter",0),("stage_seconds_total","counter",1)]
+        for name, kind, col in metrics:
+            lines.append("# TYPE " + self.prefix + "_" + name + " " + kind)
+            for stage, vals in stages:
+                lines.append(self.prefix + "_" + name + '{stage="' + stage + '"} ' + repr(vals[col]))
+
+        return "\n".join(lines) + "\n"
+
+_noinstrumentation = Instrumentation()
+
+#Decides when each HTTP request to a server may start, so that bulk work can't starve live data.
+#Requests belong to a priority class - live, interactive or bulk. Each class can have a limit on the number of requests
+# in flight and can be rate limited by a shared token bucket. When a request finishes, the waiting request from the
+# highest priority class that is allowed to run goes next.
+class RequestScheduler:
+    CLASSES = ["live","interactive","bulk"]
+
+    def __init__(self,inflight=None,rate=None,burst=None,limited=("interactive","bulk")):
+        #Maximum requests in flight per class (None for no limit)
+        self.inflight = {'live': None,'interactive': None,'bulk': 4}
+        if inflight is not None:
+            self.inflight.update(inflight)
+
+        #Token bucket - 'rate' requests per second with bursts of up to 'burst', applied to the 'limited' classes
+        self.rate = rate
+        self.burst = burst
+        if self.burst is None and rate is not None:
+            self.burst = max(rate,1)
+        self.limited = set(limited)
+        self.tokens = self.burst
+        self.refilled = time.perf_counter()
+
+        self.condition = threading.Condition()
+        self.waiting = collections.deque()
+        self.sequence = 0
+        self.running = {c: 0 for c in RequestScheduler.CLASSES}
+
+        #Metrics for each class
+        self.queued = {c: 0 for c in RequestScheduler.CLASSES}
+        self.completed = {c: 0 for c in RequestScheduler.CLASSES}
+        self.waited = {c: 0.0 for c in RequestScheduler.CLASSES}
+        self.maxwait = {c: 0.0 for c in RequestScheduler.CLASSES}
+
+    #The default class for a request, based on its name
+    def Classify(self,name):
+        if name.startswith("subscription."):
+            return "live"
+        return "interactive"
+
+    #Wait until a request of the given class may start. Returns the time spent waiting.
+    def Acquire(self,cls):
+        start = time.perf_counter()
+        with self.condition:
+            self.sequence += 1
+            ticket = (RequestScheduler.CLASSES.index(cls),self.sequence,cls)
+            self.waiting.append(ticket)
+            self.queued[cls] += 1
+            try:
+                while True:
+                    delay = self._ready(ticket)
+                    if delay == 0:
+                        break
+                    self.condition.wait(delay)
+            finally:
+                self.waiting.remove(ticket)
+                self.queued[cls] -= 1
+
+            self.running[cls] += 1
+            if self.rate is not None and cls in self.limited:
+                self.tokens -= 1
+
+            waited = time.perf_counter() - start
+            self.waited[cls] += waited
+            if waited > self.maxwait[cls]:
+                self.maxwait[cls] = waited
+            self.condition.notify_all()
+            return waited
+
+    #Mark a request as finished
+    def Release(self,cls):
+        with self.condition:
+            self.running[cls] -= 1
+            self.completed[cls] += 1
+            self.condition.notify_all()
+
+    #Current queue lengths, requests in flight and wait times for each class
+    def Stats(self):
+        with self.condition:
+            stats = {}
+            for c in RequestScheduler.CLASSES:
+                done = self.completed[c]
+                stats[c] = { 'queued': self.queued[c], 'inflight': self.running[c], 'completed': done,
+                             'wait': self.waited[c], 'maxwait': self.maxwait[c], 'avgwait': (self.waited[c] / done) if done > 0 else 0 }
+            return stats
+
+    #Internal: Return 0 if the ticket can run now, otherwise how long to wait before checking again (None to wait for a change)
+    def _ready(self,ticket):
+        if not self._allowed(ticket[2]):
+            return None
+
+        #Anything from a higher priority class (or earlier in the same class) that could run goes first
+        for other in self.waiting:
+            if other < ticket and self._allowed(other[2]):
+                return None
+
+        if self.rate is not None and ticket[2] in self.limited:
+            now = time.perf_counter()
+            self.tokens = min(self.burst,self.tokens + (now - self.refilled) * self.rate)
+            self.refilled = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    #Internal: True if the class is below its in-flight limit
+    def _allowed(self,cls):
+        limit = self.inflight.get(cls)
+        return limit is None or self.running[cls] < limit
+
+#Remembers how to reach each ARDI server (scheme, port, data contexts, timezone) and its configuration, so that
+# repeated start-ups don't have to probe the server. Entries are shared by every Server in the process and can
+# also be kept in a JSON file so they survive between processes.
+class ConnectionCache:
+    VERSION = 1
+    entries = {}
+    lock = threading.Lock()
+
+    def __init__(self,path=None,ttl=3600):
+        #The file to keep the cache in (None for in-process only)
+        self.path = path
+
+        #How long (in seconds) an entry can be used without checking it with the server
+        self.ttl = ttl
+
+    #Returns the cached entry for a server and whether it is still fresh, or (None,False) if there isn't a valid entry
+    def Load(self,key):
+        with ConnectionCache.lock:
+            entry = ConnectionCache.entries.get(key)
+            if entry is None and self.path is not None:
+                entry = self._read().get(key)
+                if self._valid(entry):
+                    ConnectionCache.entries[key] = entry
+
+        if not self._valid(entry):
+            return (None,False)
+        return (entry,(time.time() - entry['saved']) < self.ttl)
+
+    #Store (or update) the entry for a server
+    def Save(self,key,entry):
+        entry = dict(entry)
+        entry['version'] = ConnectionCache.VERSION
+        if 'saved' not in entry:
+            entry['saved'] = time.time()
+        with ConnectionCache.lock:
+            ConnectionCache.entries[key] = entry
+            if self.path is not None:
+                stored = self._read()
+                stored[key] = entry
+                self._write(stored)
+
+    #Forget a server (or every server if no key is given)
+    def Clear(self,key=None):
+        with ConnectionCache.lock:
+            if key is None:
+                ConnectionCache.entries.clear()
+            else:
+                ConnectionCache.entries.pop(key,None)
+            if self.path is not None:
+                stored = {}
+                if key is not None:
+                    stored = self._read()
+                    stored.pop(key,None)
+                self._write(stored)
+
+    def _valid(self,entry):
+        try:
+            return entry['version'] == ConnectionCache.VERSION and entry['prefix'] in ('http://','https://') and len(entry['contexts']) > 0 and float(entry['saved']) > 0
+        except:
+            return False
+
+    def _read(self):
+        try:
+            with open(self.path,"r") as fl:
+                stored = json.load(fl)
+            if isinstance(stored,dict):
+                return stored
+        except:
+            pass
+        return {}
+
+    def _write(self,stored):
+        try:
+            tmp = self.path + ".tmp"
+            with open(tmp,"w") as fl:
+                json.dump(stored,fl)
+            os.replace(tmp,self.path)
+        except:
+            print("Unable to write ARDI connection cache " + str(self.path))
+            traceback.print_exc()
+
 #This defines a single ARDI context - a port to READ from and one to WRITE to
 class Context:
     def __init__(self):
@@ -43,6 +426,31 @@ class Server:
             self.prefix = "http://"
         self.contexts = []
 
+        #Optional cache/de-duplication of AQL queries (see EnableCache)
+        self.cache = None
+
+        #Receives the timing of every HTTP call (see SetInstrumentation)
+        self.instrumentation = _noinstrumentation
+
+        #Controls how many requests of each priority class run at once (see SetScheduler)
+        self.scheduler = RequestScheduler()
+
+        #HTTP session shared by every request to this server, so connections are kept alive and re-used
+        self.http = requests.Session()
+
+        #Optional background fetching of the next history window (see EnablePrefetch)
+        self.prefetcher = None
+
+        #How long (in seconds) to wait for the HTTPS probe in Connect before falling back to HTTP
+        self.probetimeout = 3
+
+        #Optional cache of the connection details and configuration (see EnableConnectionCache)
+        self.connectioncache = None
+        self.cachekey = None
+
+        #Indexed property & relationship names (see GetCatalogue)
+        self.catalogue = None
+
         #Extract detail from the URL if the site was not given but is contained in the /s/
         bits = srv.split("/")
         if bits[0] == "":
@@ -51,37 +459,47 @@ class Server:
             self.site = bits[2]
             self.server = bits[0]        
 
+        self.original = (self.server,self.webport,self.prefix)
+
+    #Remember the connection details (and configuration) of this server between calls to Connect, and
+    # optionally between processes if a path is given. Entries older than 'ttl' seconds are re-checked.
+    def EnableConnectionCache(self,path=None,ttl=3600):
+        self.connectioncache = ConnectionCache(path,ttl)
+        self.cachekey = self.original[2] + self.original[0] + ":" + str(self.original[1]) + "/s/" + self.site
+        return self.connectioncache
+
     #Connect to the ARDI server
     def Connect(self):
-        con = False
-
-        #Attempt HTTPS...
-        if self.prefix == "https://":
-            url = "https://" + self.server + '/s/' + self.site + '/api/connect'            
-            self.prefix = "https://"
+        cached = None
+        if self.connectioncache is not None:
+            cached, fresh = self.connectioncache.Load(self.cachekey)
+            if cached is not None and fresh:
+                self._restoreConnection(cached)
+                return True
+
+        resp = None
+        if cached is not None:
+            #Re-check the scheme that worked last time instead of probing
+            self._restoreConnection(cached)
             try:
-                resp = requests.get(url)          
-                if resp.status_code == 200:
-                    con = True
-                    if self.webport is None or self.webport == "80":
-                        self.webport = "443"
-                    self.server = self.server.replace(":80","")
+                resp = self._request("GET",self.prefix + self.server + '/s/' + self.site + '/api/connect',"connect",timeout=self.probetimeout)
+                if resp.status_code != 200:
+                    resp = None
             except:
-                pass
+                resp = None
 
-        #If HTTPS connection fails...
-        if con == False:            
-            url =  "http://" + self.server + '/s/' + self.site + '/api/connect'                
-            self.prefix = "http://"            
-            if self.webport is None:
-                self.webport = "80"
-            resp = requests.get(url)
+            if resp is None:
+                self.server, self.webport, self.prefix = self.original
+
+        if resp is None:
+            resp = self._probe()
 
         # HTTP response code, e.g. 200.
         if resp.status_code == 200:            
 
             #print 'XML Content: ' + buffer.getvalue()
             xml = xmltodict.parse(resp.text)
+            self.contexts = []
             
             #Parse the details of the server
             for d in xml['ardi']['service']:                
@@ -114,15 +532,86 @@ class Server:
                         traceback.print_exc()
                         self.timezone = pytz.utc
 
+            if self.connectioncache is not None and len(self.contexts) > 0:
+                self._saveConnection()
+
             return True
         else:
             #ar.close()
             return False        
+
+    #Internal: Find out whether the server talks HTTPS or HTTP and return its /api/connect response
+    def _probe(self):
+        con = False
+
+        #Attempt HTTPS...
+        if self.prefix == "https://":
+            url = "https://" + self.server + '/s/' + self.site + '/api/connect'            
+            self.prefix = "https://"
+            try:
+                resp = self._request("GET",url,"connect",timeout=self.probetimeout)
+                if resp.status_code == 200:
+                    con = True
+                    if self.webport is None or self.webport == "80":
+                        self.webport = "443"
+                    self.server = self.server.replace(":80","")
+            except:
+                pass
+
+        #If HTTPS connection fails...
+        if con == False:            
+            url =  "http://" + self.server + '/s/' + self.site + '/api/connect'                
+            self.prefix = "http://"            
+            if self.webport is None:
+                self.webport = "80"
+            resp = self._request("GET",url,"connect")
+
+        return resp
+
+    #Internal: Use previously cached connection details
+    def _restoreConnection(self,entry):
+        self.prefix = entry['prefix']
+        self.server = entry['server']
+        self.webport = entry['webport']
+
+        self.contexts = []
+        for c in entry['contexts']:
+            ctx = Context()
+            ctx.consolidator = c[0]
+            ctx.server = c[1]
+            ctx.name = c[2]
+            self.contexts.append(ctx)
+
+        self.timezone = None
+        if entry.get('timezone') is not None:
+            self.timezone = pytz.timezone(entry['timezone'])
+
+    #Internal: Store the current connection details in the cache (keeping any cached configuration)
+    def _saveConnection(self):
+        entry = {}
+        old, fresh = self.connectioncache.Load(self.cachekey)
+        if old is not None and old['prefix'] == self.prefix and old['server'] == self.server:
+            entry['configuration'] = old.get('configuration')
+            entry['configsaved'] = old.get('configsaved')
+
+        zone = None
+        if self.timezone is not None:
+            zone = str(self.timezone)
+
+        entry.update({ 'prefix': self.prefix, 'server': self.server, 'webport': self.webport, 'timezone': zone, 'saved': time.time(),
+            'contexts': [[c.consolidator,c.server,c.name] for c in self.contexts] })
+        self.connectioncache.Save(self.cachekey,entry)
         
+
     #Get key configuration data from the ARDI server
     def GetConfiguration(self):
+        if self.connectioncache is not None:
+            cached, fresh = self.connectioncache.Load(self.cachekey)
+            if cached is not None and cached.get('configuration') is not None and (time.time() - cached['configsaved']) < self.connectioncache.ttl:
+                return [[dict(x) for x in cached['configuration'][0]],[dict(x) for x in cached['configuration'][1]]]
+
         url = self.prefix + self.server + ':' + str(self.webport) + '/s/' + self.site + '/api/getconfiguration'
-        resp = requests.get(url)
+        resp = self._request("GET",url,"getconfiguration")
 
         # HTTP response code, e.g. 200.
         if resp.status_code == 200:
@@ -141,14 +630,30 @@ class Server:
                 props.append({ 'name' : ele['@name'], 'type' : ele['@type'], 'id' : ele['@id'] })
         else:
             return None
-                
-        ar.close()        
+
+        if self.connectioncache is not None:
+            cached, fresh = self.connectioncache.Load(self.cachekey)
+            if cached is not None:
+                cached = dict(cached)
+                cached['configuration'] = [[dict(x) for x in rels],[dict(x) for x in props]]
+                cached['configsaved'] = time.time()
+                self.connectioncache.Save(self.cachekey,cached)
+
         return [rels,props]
 
+    #Get the indexed catalogue of property and relationship names, loading it on first use
+    def GetCatalogue(self,refresh=False):
+        if self.catalogue is None:
+            self.catalogue = Catalogue(self)
+            self.catalogue.Refresh()
+        elif refresh == True:
+            self.catalogue.Refresh()
+        return self.catalogue
+
     #Get information about individual data sources
     def GetDataSourceInfo(self):        
         url = self.prefix + self.server + ':' + str(self.port) + '/api/getdatasources.php'
-        resp = requests.get(url)        
+        resp = self._request("GET",url,"getdatasources")
 
         # HTTP response code, e.g. 200.
         if resp.status_code == 200:            
@@ -172,6 +677,55 @@ class Server:
     def Endpoint(self):
         return self.prefix + self.server + ':' + str(self.webport) + "/s/" + self.site
 
+    #Send timings for HTTP calls and processing stages to an Instrumentation object (None to disable)
+    def SetInstrumentation(self,inst):
+        if inst is None:
+            inst = _noinstrumentation
+        self.instrumentation = inst
+
+    #Internal: Make a timed HTTP request to the server
+    def _request(self,method,url,name,priority=None,**kwargs):
+        scheduler = self.scheduler
+        if priority is None:
+            priority = scheduler.Classify(name)
+        waited = scheduler.Acquire(priority)
+        self.instrumentation.Stage("queue." + priority,waited)
+        try:
+            start = time.perf_counter()
+            try:
+                resp = self.http.request(method,url,**kwargs)
+            except:
+                self.instrumentation.Call(name,time.perf_counter() - start,0,ok=False)
+                raise
+            self.instrumentation.Call(name,time.perf_counter() - start,len(resp.content))
+        finally:
+            scheduler.Release(priority)
+        return resp
+
+    #Replace the request scheduler that controls how many requests of each priority run at once
+    def SetScheduler(self,scheduler):
+        self.scheduler = scheduler
+
+    #Share identical AQL queries between threads and cache their results for 'ttl' seconds
+    def EnableCache(self,ttl=5,size=128):
+        self.cache = QueryCache(ttl=ttl,size=size)
+        return self.cache
+
+    #Stop caching AQL query results
+    def DisableCache(self):
+        self.cache = None
+
+    #Fetch the next window of history in the background when requests walk forward through time (see Prefetcher)
+    def EnablePrefetch(self,budget=256*1024*1024,workers=2):
+        self.prefetcher = Prefetcher(self,budget=budget,workers=workers)
+        return self.prefetcher
+
+    #Stop prefetching history, discarding anything already fetched
+    def DisablePrefetch(self):
+        if self.prefetcher is not None:
+            self.prefetcher.Close()
+        self.prefetcher = None
+
     #Create an AQL query object
     def StartQuery(self):
         return AQLQuery(self)
@@ -181,7 +735,7 @@ class Server:
         if self.timezone == None:
             print("WARNING: Unknown Time Zone. Old server, or not connected.")
             return dt
-        dt = dt.replace(tzinfo=self.timezone)
+        dt = _withZone(dt,self.timezone)
         return dt.astimezone(pytz.utc).replace(tzinfo=None)
 
     #Convert a UTC time to local time
@@ -192,6 +746,113 @@ class Server:
         dt = dt.replace(tzinfo=pytz.utc)
         return dt.astimezone(self.timezone).replace(tzinfo=None)
 
+#A single property or relationship from the server configuration
+class CatalogueEntry:
+    __slots__ = ('name','id','type')
+
+    def __init__(self,name,id,type=None):
+        self.name = name
+        self.id = id
+        self.type = type
+
+    def __repr__(self):
+        return self.name + " (" + self.id + ")"
+
+#The property and relationship names of an ARDI server, indexed by name and by ID
+class Catalogue:
+    def __init__(self,server):
+        self.server = server
+        self.properties = {}
+        self.relationships = {}
+        self.propertynames = {}
+        self.relationshipnames = {}
+        self.types = {}
+
+    #Re-load the configuration from the server, only changing the entries that have been added, renamed or removed.
+    # Returns the number of entries that changed, or None if the configuration couldn't be loaded.
+    def Refresh(self):
+        config = self.server.GetConfiguration()
+        if config is None:
+            return None
+
+        changes = self._merge(self.relationships,self.relationshipnames,[(x['name'],x['id'],None) for x in config[0]])
+        changes += self._merge(self.properties,self.propertynames,[(x['name'],x['id'],x['type']) for x in config[1]])
+
+        if changes > 0:
+            self.types = {}
+            for entry in self.properties.values():
+                if entry.type not in self.types:
+                    self.types[entry.type] = []
+                self.types[entry.type].append(entry)
+        return changes
+
+    def _merge(self,byid,byname,items):
+        changes = 0
+        seen = set()
+        for name, id, type in items:
+            id = str(id)
+            seen.add(id)
+            entry = byid.get(id)
+            if entry is not None and entry.name == name and entry.type == type:
+                continue
+
+            if entry is not None:
+                self._unindex(byname,entry)
+            entry = CatalogueEntry(sys.intern(name),sys.intern(id),type)
+            byid[id] = entry
+            byname[name] = entry
+            byname.setdefault(name.lower(),entry)
+            changes += 1
+
+        for id in [x for x in byid if x not in seen]:
+            self._unindex(byname,byid.pop(id))
+            changes += 1
+        return changes
+
+    def _unindex(self,byname,entry):
+        for key in (entry.name,entry.name.lower()):
+            if byname.get(key) is entry:
+                del byname[key]
+
+    def _find(self,byid,byname,key):
+        if isinstance(key,CatalogueEntry):
+            return key
+        entry = byid.get(str(key))
+        if entry is None:
+            entry = byname.get(key)
+        if entry is None and isinstance(key,str):
+            entry = byname.get(key.lower())
+        return entry
+
+    #Find a property by ID or name (names are matched case-insensitively if there is no exact match)
+    def Property(self,key):
+        return self._find(self.properties,self.propertynames,key)
+
+    #Find a relationship by ID or name
+    def Relationship(self,key):
+        return self._find(self.relationships,self.relationshipnames,key)
+
+    #Get the ID of a property from its name (or ID), or None if it doesn't exist
+    def PropertyID(self,key):
+        entry = self.Property(key)
+        if entry is None:
+            return None
+        return entry.id
+
+    #Get the ID of a relationship from its name (or ID), or None if it doesn't exist
+    def RelationshipID(self,key):
+        entry = self.Relationship(key)
+        if entry is None:
+            return None
+        return entry.id
+
+    #Get all of the properties of a particular type (ie. MEASUREMENT, STATUS, ENUM, TEXT, LOOKUP)
+    def PropertiesOfType(self,type):
+        return list(self.types.get(type,[]))
+
+    def __len__(self):
+        return len(self.properties) + len(self.relationships)
+
 #Convert an ARDI colour to a R/G/B tuple
 def ParseHexColour(hx):
     if hx[0] == '#':
@@ -213,22 +874,125 @@ def ParseHexColour(hx):
 
     return (r,g,b)
     
+#Trim a time-indexed data frame to the start and end times, adding rows at exactly the start and end if they
+# aren't already there. The pad rows are copied from the first and last rows of the frame, or with 'hold' set,
+# from the values in effect at the start (filling any gaps from earlier rows) and the next row after the end.
+# Without 'hold', the frame is returned as-is if fewer than two rows fall between the start and end. With it, the
+# frame is always cut to the window - an empty window is just the pad rows.
+def TrimFrame(frame,start,end,hold=False):
+    index = frame.index
+    if not index.is_monotonic_increasing:
+        frame = frame.sort_index()
+        index = frame.index
+
+    first = index.searchsorted(start,side='left')
+    last = index.searchsorted(end,side='right')
+    if hold == False and last - first < 2:
+        return frame
+    if len(index) == 0:
+        return frame
+
+    if last > first:
+        startpad = index[first] != start
+        endpad = index[last-1] != end
+    else:
+        startpad = True
+        endpad = end != start
+
+    startrow = 0
+    endrow = len(index) - 1
+    if hold == True:
+        startrow = max(first - 1,0)
+        endrow = min(last,len(index) - 1)
+
+    #Take the window and both pad rows in a single pass, so nothing needs re-sorting
+    positions = np.arange(first - int(startpad),last + int(endpad))
+    if startpad:
+        positions[0] = startrow
+    if endpad:
+        positions[-1] = endrow
+    result = frame.iloc[positions]
+
+    newindex = index[first:last]
+    if startpad:
+        newindex = newindex.insert(0,start)
+    if endpad:
+        newindex = newindex.insert(len(newindex),end)
+    result.index = newindex
+
+    #Fill gaps in the opening row from the last good value before the start
+    if hold == True and first > 0:
+        opening = result.iloc[0]
+        for c in range(0,len(result.columns)):
+            if pd.isna(opening.iloc[c]):
+                before = frame.iloc[:first,c].to_numpy()
+                good = np.flatnonzero(pd.notna(before))
+                if len(good) > 0:
+                    result.iloc[0,c] = before[good[-1]]
+
+    return result
+
+#The colour stops and value map of a single column, parsed once so they can be applied to whole arrays
+class ColumnLookup:
+    def __init__(self,meta):
+        self.colours = meta.get('colours')
+        self.stops = None
+        self.stoplist = None
+        self.colourlist = None
+        self.rgb = None
+
+        self.map = meta.get('map')
+        self.maplist = type(self.map) == list
+        self.labels = None
+        self.keys = None
+        self.keylabels = None
+
+        #Colour stops are only compiled when they are numeric and in ascending order - otherwise
+        # the scan in AQLHistResponse is used so the results are unchanged
+        if isinstance(self.colours,dict) and len(self.colours) > 0:
+            try:
+                stoplist = [float(x) for x in self.colours]
+                if all(stoplist[x] <= stoplist[x+1] for x in range(0,len(stoplist)-1)):
+                    self.stoplist = stoplist
+                    self.colourlist = [ParseHexColour(self.colours[x]) for x in self.colours]
+                    self.stops = np.array(stoplist,dtype=np.float64)
+                    self.rgb = np.array(self.colourlist,dtype=np.float64)
+            except:
+                self.stops = None
+
+        if self.map is not None:
+            if self.maplist == True:
+                self.labels = np.empty(len(self.map),dtype=object)
+                self.labels[:] = self.map
+            else:
+                keys = []
+                for k in self.map:
+                    try:
+                        if str(int(k)) == str(k):
+                            keys.append((int(k),self.map[k]))
+                    except:
+                        pass
+                keys.sort(key=lambda x: x[0])
+                self.keys = np.array([x[0] for x in keys],dtype=np.int64)
+                self.keylabels = np.empty(len(keys),dtype=object)
+                self.keylabels[:] = [x[1] for x in keys]
+
 #An AQL history response
 class AQLHistResponse:
     def __init__(self,dframe,metadata):
         self.data = dframe
         self.metadata = {}
         self.errors = []
+        self.objectcolumns = []
+        self.lookups = {}
+        if dframe is not None:
+            self.objectcolumns = dframe.attrs.get('objectcolumns',[])
         
-        for results in metadata['results']:
-            if results['type'] == 'pointlist':
-                for v in results['value']:
-                    nm = v['name'] + " " + v['propname']
-                    v['history'] = None
-                    self.metadata[nm] = v
+        metadata = AQLResult.From(metadata)
+        for p in metadata.Points():
+            self.metadata[p.Name()] = p.Metadata()
                     
-        if 'errors' in metadata:
-            self.errors = metadata['errors']
+        self.errors = metadata.errors
 
     #Gets metadata about an individual column
     def GetColumnData(self,col):
@@ -236,46 +1000,146 @@ class AQLHistResponse:
 
     #Converts a discrete column value to text
     def GetColumnText(self,name,val):
+        lookup = self._getLookup(name)
+        if lookup is not None and lookup.map is not None:
+            try:
+                if lookup.maplist == True:
+                    return lookup.map[int(val)]
+                else:
+                    return lookup.map[str(val)]
+            except:
+                pass
+
+        return str(val)
+
+    #Converts a whole array of discrete column values to text
+    def GetColumnTexts(self,name,values):
+        values = np.asarray(values)
+        out = np.empty(len(values),dtype=object)
+        lookup = self._getLookup(name)
+
+        #Integer values can be resolved directly against the compiled map
+        if lookup is not None and lookup.map is not None and np.issubdtype(values.dtype,np.integer):
+            found = np.zeros(len(values),dtype=bool)
+            if lookup.maplist == True:
+                count = len(lookup.labels)
+                pos = np.where(values < 0,values + count,values)
+                found = (pos >= 0) & (pos < count)
+                out[found] = lookup.labels[pos[found]]
+            elif len(lookup.keys) > 0:
+                pos = np.searchsorted(lookup.keys,values)
+                pos[pos >= len(lookup.keys)] = 0
+                found = lookup.keys[pos] == values
+                out[found] = lookup.keylabels[pos[found]]
+
+            missing = ~found
+            if missing.any():
+                out[missing] = self._textsByValue(name,values[missing])
+            return out
+
+        out[:] = self._textsByValue(name,values)
+        return out
+
+    #Convert each distinct value once, then broadcast the text back over the array
+    def _textsByValue(self,name,values):
+        out = np.empty(len(values),dtype=object)
         try:
-            if name in self.metadata:
-                if 'map' in self.metadata[name]:
-                    if type(self.metadata[name]['map']) == list:
-                        return self.metadata[name]['map'][int(val)]
-                    else:
-                        return self.metadata[name]['map'][str(val)]
-        except:
-            pass
-        
-        return str(val)    
+            uniq, inverse = np.unique(values,return_inverse=True)
+        except TypeError:
+            for x in range(0,len(values)):
+                out[x] = self.GetColumnText(name,values[x])
+            return out
+
+        labels = np.empty(len(uniq),dtype=object)
+        for x in range(0,len(uniq)):
+            labels[x] = self.GetColumnText(name,uniq[x].item())
+        out[:] = labels[inverse.reshape(-1)]
+        return out
 
     #Converts an analogue or discrete value to a colour
-    def GetColumnColour(self,name,val):        
+    def GetColumnColour(self,name,val):
+        lookup = self._getLookup(name)
+        if lookup is None or lookup.colours is None:
+            return "blue"
+
+        if lookup.stops is None:
+            return self._columnColourScan(name,val)
+
+        indx = bisect.bisect_right(lookup.stoplist,val)
+        if indx == 0:
+            return lookup.colourlist[0]
+
+        lastcolour = lookup.colourlist[indx-1]
+        if indx == len(lookup.stoplist):
+            perc = 0
+            nextcolour = lastcolour
+        else:
+            nextcolour = lookup.colourlist[indx]
+            lastvalue = lookup.stoplist[indx-1]
+            perc = (val - lastvalue) / (lookup.stoplist[indx] - lastvalue)
+        return ((perc * nextcolour[0]) + ((1-perc) * lastcolour[0]),(perc * nextcolour[1]) + ((1-perc) * lastcolour[1]),(perc * nextcolour[2]) + ((1-perc) * lastcolour[2]))
+
+    #Converts a whole array of analogue or discrete values to an N x 3 array of R/G/B colours
+    def GetColumnColours(self,name,values):
+        values = np.asarray(values,dtype=np.float64)
+        lookup = self._getLookup(name)
+        if lookup is None or lookup.colours is None:
+            return np.tile(np.array([0.0,0.0,1.0]),(len(values),1))
+
+        if lookup.stops is None:
+            return np.array([self._columnColourScan(name,v) for v in values],dtype=np.float64).reshape(-1,3)
+
+        count = len(lookup.stops)
+        indx = np.searchsorted(lookup.stops,values,side='right')
+        lo = np.clip(indx - 1,0,count - 1)
+        hi = np.clip(indx,0,count - 1)
+
+        span = lookup.stops[hi] - lookup.stops[lo]
+        edge = (indx == 0) | (indx == count)
+        span[edge] = 1
+        perc = (values - lookup.stops[lo]) / span
+        perc[edge] = 0
+
+        perc = perc[:,None]
+        return (perc * lookup.rgb[hi]) + ((1-perc) * lookup.rgb[lo])
+
+    #Gets (and compiles on first use) the colour and value lookups for a column
+    def _getLookup(self,name):
+        try:
+            return self.lookups[name]
+        except KeyError:
+            pass
+
+        lookup = None
         if name in self.metadata:
-            if 'colours' in self.metadata[name]:                                    
-                lastcolour = (0,0,0)
-                lastvalue = None
-                for x in self.metadata[name]['colours']:
-                    fx = float(x)
-                    if lastvalue is None:
-                        lastcolour = ParseHexColour(self.metadata[name]['colours'][x])
-                        
-                    if fx > val:                        
-                        break
-                    
-                    lastcolour = ParseHexColour(self.metadata[name]['colours'][x])
-                    lastvalue = fx
-
-                if lastvalue is None:                    
-                    return lastcolour
-                else:                    
-                    nextcolour = ParseHexColour(self.metadata[name]['colours'][x])
-                    if fx == lastvalue:
-                        perc = 0
-                    else:
-                        perc = (val - lastvalue) / (fx - lastvalue)
-                    return ((perc * nextcolour[0]) + ((1-perc) * lastcolour[0]),(perc * nextcolour[1]) + ((1-perc) * lastcolour[1]),(perc * nextcolour[2]) + ((1-perc) * lastcolour[2]))
+            lookup = ColumnLookup(self.metadata[name])
+        self.lookups[name] = lookup
+        return lookup
+
+    #The original colour search, used when the colour stops can't be compiled (unsorted or non-numeric keys)
+    def _columnColourScan(self,name,val):
+        lastcolour = (0,0,0)
+        lastvalue = None
+        for x in self.metadata[name]['colours']:
+            fx = float(x)
+            if lastvalue is None:
+                lastcolour = ParseHexColour(self.metadata[name]['colours'][x])
                 
-        return "blue"
+            if fx > val:                        
+                break
+            
+            lastcolour = ParseHexColour(self.metadata[name]['colours'][x])
+            lastvalue = fx
+
+        if lastvalue is None:                    
+            return lastcolour
+        else:                    
+            nextcolour = ParseHexColour(self.metadata[name]['colours'][x])
+            if fx == lastvalue:
+                perc = 0
+            else:
+                perc = (val - lastvalue) / (fx - lastvalue)
+            return ((perc * nextcolour[0]) + ((1-perc) * lastcolour[0]),(perc * nextcolour[1]) + ((1-perc) * lastcolour[1]),(perc * nextcolour[2]) + ((1-perc) * lastcolour[2]))
 
     #Returns a colour map from a property name (used for discrete properties)
     def GetColourMap(self,name):        
@@ -306,6 +1170,168 @@ class AQLHistResponse:
                     return self.metadata[name]['map']
         return {}
 
+#Convert a value to a floating point number if possible
+def cvFloat(dta):
+    if dta == "^":
+        return None
+    else:
+        try:
+            v = float(dta)
+            if v != "NaN":
+                return v
+        except:
+            return dta
+    return dta
+
+#Convert a value to an integer value if possible
+def cvInt(dta):
+    if dta == "^":
+        return None
+    else:
+        v = int(dta)
+        if v != "NaN":
+            return v
+    return dta
+
+#Internal: Import pyarrow, which is only needed for Arrow output
+def _pyarrow():
+    try:
+        return importlib.import_module("pyarrow")
+    except ImportError:
+        raise ImportError("Arrow output needs the pyarrow package - install it with 'pip install pyarrow'")
+
+#A single point from an AQL result. The history (if any) is decoded once into a column of timestamps and a
+# column of values, which every consumer of the result shares. The samples are then removed from the JSON, so
+# they aren't held twice.
+class AQLPoint:
+    __slots__ = ('record','name','propname','type','sourceid','propid','value','units','min','max','map','colours','times','values','index','_metadata')
+
+    def __init__(self,record):
+        #The original JSON for the point, without its history
+        self.record = record
+
+        self.name = record.get('name')
+        self.propname = record.get('propname')
+        self.type = record.get('type')
+        self.sourceid = record.get('sourceid')
+        self.propid = record.get('propid')
+        self.value = record.get('value')
+        self.units = record.get('units')
+        self.min = record.get('min')
+        self.max = record.get('max')
+        self.map = record.get('map')
+        self.colours = record.get('colours')
+
+        #Timestamps (as text, in server time), the decoded values and optionally an already-converted time index
+        self.times = None
+        self.values = None
+        self.index = None
+        self._metadata = None
+
+        history = record.pop('history',None)
+        if history is not None:
+            self.times = np.array([i[0] for i in history],dtype=object)
+            self.values = self._decode(history)
+
+    def _decode(self,history):
+        #Points with a value map hold integers, unless any of the values isn't one
+        try:
+            if len(self.record['map']) > 0:
+                pass
+            series = pd.Series([cvInt(i[1]) for i in history])
+        except:
+            series = pd.Series([cvFloat(i[1]) for i in history])
+
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            return series.to_numpy()
+        return series.array
+
+    #The default column name of the point
+    def Name(self):
+        return self.name + " " + self.propname
+
+    #The JSON for the point, with the history rebuilt from the decoded samples
+    def JSON(self):
+        record = dict(self.record)
+        if self.times is not None:
+            record['history'] = [[tm,_sampleText(value)] for tm, value in zip(self.times,self.values)]
+        return record
+
+    #The point details without the history
+    def Metadata(self):
+        if self._metadata is None:
+            meta = dict(self.record)
+            meta['history'] = None
+            self._metadata = meta
+        return self._metadata
+
+#Internal: A decoded history value as AQL text - bad values are '^'
+def _sampleText(value):
+    if value is None or (not isinstance(value,str) and pd.isna(value)):
+        return "^"
+    if isinstance(value,(float,np.floating)):
+        return "%.15g" % value
+    return str(value)
+
+#A parsed AQL response. Points are only decoded the first time they are needed, and the same
+# AQLResult can be shared (ie. through the query cache) by every consumer.
+class AQLResult:
+    def __init__(self,raw):
+        #The original JSON response
+        self.raw = raw
+        self.errors = []
+        if 'errors' in raw:
+            self.errors = raw['errors']
+        self.points = None
+        self.lock = threading.Lock()
+
+        #The size of the response it was parsed from (if known)
+        self.nbytes = 0
+
+    #Wrap a raw JSON response (or return an existing AQLResult)
+    @staticmethod
+    def From(results):
+        if isinstance(results,AQLResult):
+            return results
+        return AQLResult(results)
+
+    #All of the points in the result, in order
+    def Points(self):
+        if self.points is None:
+            with self.lock:
+                if self.points is None:
+                    points = []
+                    for q in self.raw['results']:
+                        if q['type'] == "pointlist":
+                            for r in q['value']:
+                                points.append(AQLPoint(r))
+                    self.points = points
+        return self.points
+
+    #The response as JSON. Decoding the points removes their history from the raw response, so once they have
+    # been decoded it is rebuilt from them.
+    def JSON(self):
+        if self.points is None:
+            return self.raw
+        points = iter(self.points)
+        js = dict(self.raw)
+        js['results'] = []
+        for q in self.raw['results']:
+            if q['type'] == "pointlist":
+                q = dict(q)
+                q['value'] = [next(points).JSON() for r in q['value']]
+            js['results'].append(q)
+        return js
+
+    #Allows an AQLResult to be used in place of the raw JSON
+    def __getitem__(self,key):
+        if key == 'results':
+            return self.JSON()[key]
+        return self.raw[key]
+
+    def __contains__(self,key):
+        return key in self.raw
+
 #This is used to pass parameters for an AQL query
 class AQLHistRequest:
     def __init__(self,query,args=None):
@@ -332,6 +1358,12 @@ class AQLHistRequest:
         self.span = None
         self.mode = "interp"
         self.context = 1
+        self.compact = False
+        self.float32 = False
+        self.processes = None
+        self.grid = None
+        self.priority = None
+        self.arrow = False
 
     #Sets the name of the 'local' timezone
     def SetLocalTimezone(self,tz):
@@ -367,16 +1399,211 @@ class AQLHistRequest:
     def Max(self):
         self.mode = "max"
 
+    #Decode the response(s) in worker processes - either a number of processes or an existing ProcessPoolExecutor.
+    #Each response is decoded by one worker, so set chunks to spread a large request across several.
+    def UseProcesses(self,processes=None):
+        if processes is None:
+            processes = os.cpu_count()
+        self.processes = processes
+
+    #Return memory-compact columns (categorical discrete values, optionally float32 analogue values)
+    def Compact(self,float32=False):
+        self.compact = True
+        self.float32 = float32
+
+    #Return every column on a fixed grid - one row every 'step' (seconds or a timedelta) - instead of at each recorded time
+    def Grid(self,step):
+        if not isinstance(step,datetime.timedelta):
+            step = datetime.timedelta(seconds=step)
+        self.grid = step
+
+    #Return the history as an Arrow table (see AQLQuery.HistoryToArrow) rather than a data frame
+    def Arrow(self):
+        self.arrow = True
+
+    #The scheduler class to send the request as. Unless set, chunked and multi-process requests are 'bulk'.
+    def GetPriority(self):
+        if self.priority is not None:
+            return self.priority
+        if self.chunks is not None or self.processes is not None:
+            return "bulk"
+        return "interactive"
+
+    #The compiled plan for this request's query
+    def Plan(self):
+        return AQLPlan.Compile(self.query)
+
+#Internal: Attach a timezone to a naive time. pytz zones have to localize the time - replacing its tzinfo uses the
+# zone's first (local mean time) offset.
+def _withZone(dt,zone):
+    if hasattr(zone,'localize'):
+        return zone.localize(dt.replace(tzinfo=None))
+    return dt.replace(tzinfo=zone)
+
+#Internal: Format a time the way the AQL history parameters expect it (YYYY-MM-DD HH:MM:SS)
+def _aqlTime(dt):
+    return dt.isoformat(' ','seconds')[0:19]
+
+#A compiled history query. The query is parsed once to find its parameter block - the last {...} outside of
+# any quoted text - and the time range is then rendered into it for each request or chunk.
+class AQLPlan:
+    plans = collections.OrderedDict()
+    lock = threading.Lock()
+    size = 256
+
+    def __init__(self,query):
+        self.query = query
+        self.head = None
+        self.tail = ""
+        self.extra = ""
+        self.bodies = {}
+
+        #Find the last opening brace that isn't inside a string
+        quote = None
+        start = -1
+        for n, ch in enumerate(query):
+            if quote is not None:
+                if ch == quote:
+                    quote = None
+            elif ch == '"' or ch == "'":
+                quote = ch
+            elif ch == '{':
+                start = n
+
+        if start == -1:
+            raise ValueError("AQL history query has no {} parameter block - " + query)
+
+        #Find the matching closing brace, allowing for nested objects and strings
+        depth = 0
+        quote = None
+        end = -1
+        for n in range(start,len(query)):
+            ch = query[n]
+            if quote is not None:
+                if ch == quote:
+                    quote = None
+            elif ch == '"':
+                quote = ch
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    end = n
+                    break
+
+        if end == -1:
+            raise ValueError("AQL history query has an unterminated {} parameter block - " + query)
+
+        self.head = query[0:start] + '{"start": "'
+        self.tail = query[end:]
+        self.extra = query[start+1:end].strip()
+        if self.extra != "":
+            self.extra = ", " + self.extra
+
+    #Return the (shared) plan for a query, compiling it if it hasn't been seen recently
+    @staticmethod
+    def Compile(query):
+        with AQLPlan.lock:
+            plan = AQLPlan.plans.get(query)
+            if plan is not None:
+                AQLPlan.plans.move_to_end(query)
+                return plan
+
+        plan = AQLPlan(query)
+        with AQLPlan.lock:
+            AQLPlan.plans[query] = plan
+            while len(AQLPlan.plans) > AQLPlan.size:
+                AQLPlan.plans.popitem(last=False)
+        return plan
+
+    #Render the query for a single time range
+    def Render(self,start,end,grain,mode):
+        body = self.bodies.get(mode)
+        if body is None:
+            body = '", "method": "' + mode + '"' + self.extra
+            self.bodies[mode] = body
+        return self.head + _aqlTime(start) + '","end": "' + _aqlTime(end) + '", "grain": "' + str(grain) + body + self.tail
+
+    #Render the queries for a history request - a list of ([start,end],query), one for each chunk
+    def Requests(self,req):
+        grain = 0
+        if req.samples is None and req.span is None:
+            grain = -100
+        else:
+            if req.samples is not None:
+                grain = -req.samples
+            else:
+                grain = req.span        
+
+        if req.chunks is None:
+            return [(req.GetTrim(),self.Render(req.sd,req.ed,grain,req.mode))]
+
+        chunkset = []
+        curr = req.sd
+        step = datetime.timedelta(hours=req.chunks)
+        length = datetime.timedelta(seconds=(60*60*req.chunks)-1)
+
+        ttime = 0
+        while curr < req.ed:
+            dend = curr + length
+            if dend > req.ed:
+                dend = req.ed
+            chunkset.append([curr,dend])
+            ttime = ttime + (dend - curr).total_seconds()
+            curr = curr + step
+
+        queries = []
+        for chunk in chunkset:                
+            chunkgrain = grain
+            if chunkgrain < 0:
+                chunkgrain = int(grain * ((chunk[1] - chunk[0]).total_seconds() / ttime))
+            queries.append((chunk,self.Render(chunk[0],chunk[1],chunkgrain,req.mode)))
+
+        return queries
+
 #Represents an AQL query
 class AQLQuery:
     def __init__(self,server):
         self.server = server
 
-    #Run the AQL query
+    #Run the AQL query, returning the raw JSON response
     def Execute(self,query):
+        return self.Query(query).JSON()
+
+    #Run the AQL query, returning an AQLResult. Priority is the scheduler class (live, interactive or bulk) to send it as.
+    def Query(self,query,priority=None):
+        if self.server.cache is None:
+            return self._execute(query,priority)
+
+        query = query.strip()
+        return self.server.cache.Get((self.server.Endpoint(),query),lambda: self._execute(query,priority))
+
+    #Send an AQL query to the server
+    def _execute(self,query,priority=None):
         url = self.server.Endpoint() + "/api/aql/query"        
-        req = requests.post(url,{ "query": query })    
-        return req.json()
+        req = self.server._request("POST",url,"execute",priority=priority,data={ "query": query })
+        start = time.perf_counter()
+        js = req.json()
+        self.server.instrumentation.Stage("parse",time.perf_counter() - start)
+        result = AQLResult(js)
+        result.nbytes = len(req.content)
+        return result
+
+    #Internal: The instrumentation for this query's server
+    def _inst(self):
+        if self.server is None:
+            return _noinstrumentation
+        return self.server.instrumentation
+
+    #Build the AQL for a single point from an asset ID and a property (by ID or name)
+    def PointQuery(self,asset,prop,suffix="VALUES"):
+        propid = str(prop)
+        if not propid.isdigit():
+            propid = self.server.GetCatalogue().PropertyID(prop)
+            if propid is None:
+                raise ValueError("Unknown ARDI property '" + str(prop) + "'")
+        return str(asset) + " ASSETBYID " + propid + " PROPERTYBYID " + suffix
 
     #Return a fresh AQLHistRequest object based on the start and end times
     def StartHistoryRequest(self,query,start,end):
@@ -404,26 +1631,11 @@ class AQLQuery:
 
     #Convert a value to a floating point number if possible
     def cvFloat(self,dta):
-        if dta == "^":
-            return None
-        else:
-            try:
-                v = float(dta)
-                if v != "NaN":
-                    return v
-            except:
-                return dta
-        return dta
+        return cvFloat(dta)
 
     #Convert a value to an integer value if possible
     def cvInt(self,dta):
-        if dta == "^":
-            return None
-        else:
-            v = int(dta)
-            if v != "NaN":
-                return v
-        return dta
+        return cvInt(dta)
 
     #Convert a YYYY-MM-DD HH:MM:SS string to a LOCAL time
     def ConvertTZString(self,dt, fromtz, totz):       
@@ -436,13 +1648,13 @@ class AQLQuery:
                 local = dt
                 return None
             
-        local = local.replace(tzinfo=fromtz)        
+        local = _withZone(local,fromtz)
         
         return local.astimezone(totz).strftime("%Y-%m-%d %H:%M:%S")
 
     #Convert a DateTime to a LOCAL time
     def ConvertTZDate(self,dt, fromtz, totz):               
-        local = dt.replace(tzinfo=fromtz)            
+        local = _withZone(dt,fromtz)
         return local.astimezone(totz).replace(tzinfo=None)
 
     #Get history from an AQLHistoryRequest
@@ -454,53 +1666,34 @@ class AQLQuery:
         if req.serverzone is None:
             req.serverzone = pytz.utc        
 
-        grain = 0
-        if req.samples is None and req.span is None:
-            grain = -100
-        else:
-            if req.samples is not None:
-                grain = -req.samples
-            else:
-                grain = req.span        
+        if self.server is not None and self.server.prefetcher is not None:
+            self.server.prefetcher.Observe(req)
+
+        if req.arrow == True:
+            return _pyarrow().Table.from_batches(list(self.HistoryBatches(req)))
+
+        if req.grid is not None:
+            results = list(self._historyResults(req,[x[1] for x in self._historyQueries(req)]))
+            #The range is in server time, but the samples are converted to local time
+            resampler = GridResampler(self.ConvertTZDate(req.sd,req.serverzone,req.localzone),self.ConvertTZDate(req.ed,req.serverzone,req.localzone),req.grid)
+            df = resampler.Resample(results,namemap=req.namemap,serverzone=req.serverzone,localzone=req.localzone,mapbad=req.mapbad,mapna=req.mapna,autofill=req.autofill,query=self)
+            if md == False:
+                return df
+            return AQLHistResponse(df,results[-1])
 
-        querystring = '{"start": %START%,"end": %END%, "grain": %GRAIN%, "method": "' + req.mode + '"'        
-            
         if req.chunks is None:
-            query = req.query.replace("{",querystring)
-            query = query.replace("%START%",'"' + str(req.sd.strftime("%Y-%m-%d %H:%M:%S")) + '"')
-            query = query.replace("%END%",'"' + str(req.ed.strftime("%Y-%m-%d %H:%M:%S")) + '"')
-            query = query.replace("%GRAIN%",'"' + str(grain) + '"')
-            
-            results = self.Execute(query)
+            query = self._historyQueries(req)[0][1]
+            results = next(self._historyResults(req,[query]))
             if md == False:
-                return self.HistoryToDataframe(results,namemap=req.namemap,mapbad=req.mapbad,mapna = req.mapna,autofill=req.autofill,pad=req.pad,trim=req.GetTrim(),serverzone = req.serverzone, localzone=req.localzone)
-            return AQLHistResponse(self.HistoryToDataframe(results,namemap=req.namemap,mapbad=req.mapbad,mapna = req.mapna,autofill=req.autofill,pad=req.pad,trim=req.GetTrim(),serverzone = req.serverzone, localzone=req.localzone),results)
+                return self.HistoryToDataframe(results,namemap=req.namemap,mapbad=req.mapbad,mapna = req.mapna,autofill=req.autofill,pad=req.pad,trim=req.GetTrim(),serverzone = req.serverzone, localzone=req.localzone,compact=req.compact,float32=req.float32)
+            return AQLHistResponse(self.HistoryToDataframe(results,namemap=req.namemap,mapbad=req.mapbad,mapna = req.mapna,autofill=req.autofill,pad=req.pad,trim=req.GetTrim(),serverzone = req.serverzone, localzone=req.localzone,compact=req.compact,float32=req.float32),results)
         else:
-            chunkset = []
-            curr = req.sd
-
-            ttime = 0
-            while curr < req.ed:
-                dend = curr + (datetime.timedelta(seconds = (60*60*req.chunks)-1))
-                if dend > req.ed:
-                    dend = req.ed
-                chunkset.append([curr,dend])
-                ttime = ttime + (dend - curr).total_seconds()
-                curr = curr + datetime.timedelta(hours=req.chunks)
+            chunkset = self._historyQueries(req)
+            queries = [x[1] for x in chunkset]
+            chunkset = [x[0] for x in chunkset]
 
             finaldf = None
-            for chunk in chunkset:                
-                chunkgrain = grain
-                if chunkgrain < 0:
-                    chunkgrain = int(grain * ((chunk[1] - chunk[0]).total_seconds() / ttime))
-                
-                query = req.query.replace("{",querystring)
-                query = query.replace("%START%",'"' + str(chunk[0].strftime("%Y-%m-%d %H:%M:%S")) + '"')
-                query = query.replace("%END%",'"' + str(chunk[1].strftime("%Y-%m-%d %H:%M:%S")) + '"')
-                query = query.replace("%GRAIN%",'"' + str(chunkgrain) + '"')
-                #print(query)                
-                
-                results = self.Execute(query)
+            for chunk, results in zip(chunkset,self._historyResults(req,queries)):
                 df = self.HistoryToDataframe(results,namemap=req.namemap,mapbad=req.mapbad,mapna = req.mapna,autofill=req.autofill,pad=req.pad,trim=chunk,serverzone = req.serverzone, localzone=req.localzone)
                 #print("Frame Contains Data From " + str(df.index[0]) + " to " + str(df.index[len(df.index)-1]))
                 if finaldf is None:
@@ -509,91 +1702,259 @@ class AQLQuery:
                     finaldf = pd.concat([finaldf,df])
                     #finaldf = finaldf.append(df)
 
+            #Compact once the chunks are joined, so categories are consistent across the whole frame
+            if req.compact == True and finaldf is not None:
+                finaldf = self.CompactDataframe(finaldf,results,namemap=req.namemap,float32=req.float32)
+
             if md == False:
                 return finaldf
             else:
                 return AQLHistResponse(finaldf,results)
 
+    #Internal: Build the AQL for a history request - a list of ([start,end],query) for each chunk
+    def _historyQueries(self,req):
+        return req.Plan().Requests(req)
+
+    #Internal: Run each of the history queries in turn, returning the results in order.
+    # If the request uses worker processes, the raw responses are decoded there while the next one is fetched.
+    def _historyResults(self,req,queries):
+        priority = req.GetPriority()
+        if req.processes is None:
+            prefetcher = None
+            if self.server is not None:
+                prefetcher = self.server.prefetcher
+            for query in queries:
+                start = time.perf_counter()
+                results = None
+                if prefetcher is not None:
+                    results = prefetcher.Take(query)
+                if results is None:
+                    results = self.Query(query,priority)
+                self._inst().Stage("fetch",time.perf_counter() - start)
+                yield results
+            return
+
+        pool = req.processes
+        if not isinstance(pool,concurrent.futures.Executor):
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(int(req.processes),len(queries)))
+
+        futures = []
+        try:
+            for query in queries:
+                start = time.perf_counter()
+                url = self.server.Endpoint() + "/api/aql/query"
+                resp = self.server._request("POST",url,"execute",priority=priority,data={ "query": query.strip() })
+                self._inst().Stage("fetch",time.perf_counter() - start)
+                futures.append(pool.submit(_decodeHistory,resp.content,req.serverzone,req.localzone))
+
+            while len(futures) > 0:
+                start = time.perf_counter()
+                results = _attachHistory(futures.pop(0).result())
+                self._inst().Stage("collect",time.perf_counter() - start)
+                yield results
+        finally:
+            #Release the shared memory of any chunks that were decoded but never collected (ie. the consumer
+            # stopped early or raised)
+            for f in futures:
+                f.cancel()
+            for f in futures:
+                if f.cancelled():
+                    continue
+                try:
+                    _releaseHistory(f.result())
+                except:
+                    pass
+            if pool is not req.processes:
+                pool.shutdown(wait=True,cancel_futures=True)
+
+    #Get history as a series of Arrow record batches, one for each chunk of the request
+    def HistoryBatches(self,req):
+        if req.localzone is None:
+            req.localzone = pytz.utc
+        if req.serverzone is None:
+            req.serverzone = pytz.utc
+
+        schema = None
+        for results in self._historyResults(req,[x[1] for x in self._historyQueries(req)]):
+            batch = self.HistoryToArrow(results,namemap=req.namemap,serverzone=req.serverzone,localzone=req.localzone,schema=schema)
+            if schema is None:
+                schema = batch.schema
+            yield batch
+
+    #Write history to an Arrow IPC stream, one batch per chunk, so it can be read (or memory-mapped) without pandas.
+    #Sink is a file name or a writable file. Returns the number of batches written.
+    def StreamHistory(self,req,sink):
+        pa = _pyarrow()
+        writer = None
+        count = 0
+        try:
+            for batch in self.HistoryBatches(req):
+                if writer is None:
+                    writer = pa.ipc.new_stream(sink,batch.schema)
+                writer.write_batch(batch)
+                count += 1
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
+
+    #Convert AQL history to an Arrow record batch with a 'time' column and one column per point.
+    #Points that share the same times (ie. interpolated history) use their decoded values without copying; otherwise
+    # each point is placed on the combined times, with nulls where it has no sample. The AQL point details (type, units,
+    # map, colours etc.) are stored as field metadata. If a schema is given, the batch is made to match it.
+    def HistoryToArrow(self,results,namemap=None,serverzone=None,localzone=None,schema=None):
+        pa = _pyarrow()
+        inst = self._inst()
+        stage = time.perf_counter()
+
+        names = []
+        points = []
+        times = []
+        indx = -1
+        for p in AQLResult.From(results).Points():
+            indx = indx + 1
+            if p.times is None and p.index is None:
+                continue
+            sname = p.Name()
+            if namemap is not None:
+                try:
+                    sname = namemap[indx]
+                except:
+                    pass
+            names.append(sname)
+            points.append(p)
+            times.append(self._pointIndex(p,serverzone,localzone).as_unit('ns').asi8)
+
+        if len(times) > 0:
+            alltimes = np.unique(np.concatenate(times))
+        else:
+            alltimes = np.zeros(0,dtype='int64')
+
+        arrays = [pa.array(alltimes.view('datetime64[ns]'))]
+        fields = [pa.field('time',pa.timestamp('ns'))]
+        for sname, p, t in zip(names,points,times):
+            values = p.values
+            numeric = isinstance(values,np.ndarray) and values.dtype != object
+            if numeric and len(t) == len(alltimes) and np.array_equal(t,alltimes):
+                column = pa.array(values)
+            elif numeric:
+                out = np.full(len(alltimes),np.nan,dtype=values.dtype if values.dtype.kind == 'f' else float)
+                missing = np.ones(len(alltimes),dtype=bool)
+                pos = np.searchsorted(alltimes,t)
+                out[pos] = values
+                missing[pos] = False
+                column = pa.array(out,mask=missing)
+            else:
+                out = np.full(len(alltimes),None,dtype=object)
+                out[np.searchsorted(alltimes,t)] = [None if (v is None or v != v) else str(v) for v in values]
+                column = pa.array(out,type=pa.string())
+            arrays.append(column)
+            fields.append(pa.field(sname,column.type,metadata=self._arrowMetadata(p)))
+
+        zone = ""
+        if localzone is not None:
+            zone = str(localzone)
+        batch = pa.RecordBatch.from_arrays(arrays,schema=pa.schema(fields,metadata={'timezone': zone}))
+        if schema is not None and not batch.schema.equals(schema):
+            batch = self._conformBatch(pa,batch,schema)
+
+        inst.Stage("arrow",time.perf_counter() - stage)
+        return batch
+
+    #Internal: The AQL details for a point, as Arrow field metadata
+    def _arrowMetadata(self,p):
+        meta = {}
+        for key, value in p.Metadata().items():
+            if key in ('history','value') or value is None:
+                continue
+            if isinstance(value,str):
+                meta[key] = value
+            else:
+                meta[key] = json.dumps(value)
+        return meta
+
+    #Internal: Make a batch match an earlier schema - missing columns become null and extra columns are dropped
+    def _conformBatch(self,pa,batch,schema):
+        arrays = []
+        for field in schema:
+            n = batch.schema.get_field_index(field.name)
+            if n == -1:
+                arrays.append(pa.nulls(batch.num_rows,type=field.type))
+            else:
+                arrays.append(batch.column(n).cast(field.type))
+        return pa.RecordBatch.from_arrays(arrays,schema=schema)
+
     #Convert a list of AQL points to a Dataframe
     def pointlistToDataFrame(self,results):
         columns = []
-        for q in results['results']:        
-            if q['type'] == "pointlist":
-                for r in q['value']:
-                    columns.append(r['name'] + " " + r['propname'])
+        for p in AQLResult.From(results).Points():
+            columns.append(p.Name())
         return pd.DataFrame(columns=columns)
     
     #Convert AQL history to an interpolated/complete data frame
-    def HistoryToDataframe(self,results,namemap=None,serverzone=None,localzone=None,mapbad=None,mapna=None,autofill=False,pad=True,trim=None):
+    def HistoryToDataframe(self,results,namemap=None,serverzone=None,localzone=None,mapbad=None,mapna=None,autofill=False,pad=True,trim=None,compact=False,float32=False):
         indx = -1
         frames = []
         interp = []        
-        
-        for q in results['results']:        
-            if q['type'] == "pointlist":            
-                for r in q['value']:                
-                    indx = indx + 1
-                    #Build a Pandas series from each JSON result
-                    
-                    #Get the history from the JSON
-                    timeseries = None
-                    try:
-                        timeseries = r['history']
-                    except:
-                        pass                
 
-                    if timeseries is None:
-                        continue
+        inst = self._inst()
+        stage = time.perf_counter()
+        tztime = 0
 
-                    #print(str(r))
-                    if r['type'] == 'MEASUREMENT':
-                        interp.append('cont')
-                    else:
-                        interp.append('discrete')
-
-                    #Build the channel name
-                    sname = r['name'] + " " + r['propname']
-                    if namemap is not None:
-                        try:
-                            sname = namemap[indx]
-                        except:
-                            pass
-
-                    #Get the time index, using the passed timezone if available.
-                    if serverzone == None:
-                        dindex = pd.DatetimeIndex([i[0] for i in timeseries])
-                    else:
-                        dindex = pd.DatetimeIndex([self.ConvertTZString(i[0],serverzone,localzone) for i in timeseries])
+        results = AQLResult.From(results)
+        for p in results.Points():
+            indx = indx + 1
+            #Build a Pandas series from each point
 
-                    #Add this new series to the array
-                    try:
-                        if len(r['map']) > 0:
-                            pass
-                        frames.append(pd.DataFrame([self.cvInt(i[1]) for i in timeseries],columns=[sname],index=dindex))                   
-                    except:
-                        frames.append(pd.DataFrame([self.cvFloat(i[1]) for i in timeseries],columns=[sname],index=dindex))             
+            if p.times is None and p.index is None:
+                continue
+
+            if p.type == 'MEASUREMENT':
+                interp.append('cont')
+            else:
+                interp.append('discrete')
+
+            #Build the channel name
+            sname = p.Name()
+            if namemap is not None:
+                try:
+                    sname = namemap[indx]
+                except:
+                    pass
+
+            #Get the time index, using the passed timezone if available.
+            tzstart = time.perf_counter()
+            dindex = self._pointIndex(p,serverzone,localzone)
+            tztime += time.perf_counter() - tzstart
+
+            #Add this new series to the array (sharing the decoded values rather than copying them)
+            frames.append(pd.DataFrame({ sname: p.values },index=dindex,copy=False))
+
+        inst.Stage("tz",tztime)
+        inst.Stage("decode",time.perf_counter() - stage - tztime)
+        stage = time.perf_counter()
 
         #Build up the final dataframe
         final = None        
+        badvalues, constants, policies = self._compileFill(mapbad,mapna)
 
         findex = -1
         for n in frames:
             findex = findex + 1
             #Some value substitution has to be done here, on a per-channel basis, due to the addition
             # of 'NaN' values during join operations
+            sname = n.columns[0]
             
             #Map specific I/O values as 'bad'
-            if mapbad is not None:
-                for x in mapbad:
-                    if x[0] in n.columns:                    
-                        n = n.replace(x[1],np.nan)
+            if sname in badvalues:
+                bad = badvalues[sname]
+                if len(bad) == 1:
+                    bad = bad[0]
+                n = n.replace(bad,np.nan)
 
             #Map bad values as a specific value
-            if mapna is not None:
-                for x in mapna:                
-                    if x[0] in n.columns:
-                        if x[1] != 'hold' and x[1] != 'discrete' and x[1] != 'interp' and x[1] != 'cont':                            
-                                n.fillna(value=x[1],inplace=True)
+            if sname in constants:
+                n = n.fillna(value=constants[sname])
             
             #Combine the series into a data frame 
             if final is None:
@@ -610,35 +1971,42 @@ class AQLQuery:
         #Eliminate duplicate indexes
         #print(str(final))
         final = final.groupby(level=0).last()
+
+        inst.Stage("merge",time.perf_counter() - stage)
+        stage = time.perf_counter()
         
+        #Group the columns by fill policy, so each policy is applied to a block of columns at once.
+        # Once a column has been back and forward filled, any later fill is a no-op.
+        holdcols = []
+        interpcols = []
+        contcols = []
         findex = -1
         for col in final.columns:
             findex = findex + 1
-            if mapna is not None:
-                for x in mapna:
-                    if x[0] == str(col):
-                        if x[1] == 'hold' or x[1] == 'discrete':
-                            final[col] = final[col].bfill()
-                            final[col] = final[col].ffill()                           
-                        else:
-                            if x[1] == 'interp' or x[1] == 'cont':
-                                final[col] = final[col].interpolate()
-                                final[col] = final[col].bfill()
-                                final[col] = final[col].ffill()                
-
-            if autofill == True:
-                try:
-                    if interp[findex] == 'interp' or interp[findex] == 'cont':
-                        final[col] = final[col].interpolate()                    
-                except:
-                    pass
-
-            if autofill == True:
-                final[col] = final[col].bfill()
-                final[col] = final[col].ffill()        
+            policy = policies.get(str(col))
+            if policy == 'hold':
+                holdcols.append(findex)
+            elif policy == 'interp':
+                interpcols.append(findex)
+            elif findex < len(interp) and interp[findex] == 'cont':
+                contcols.append(findex)
+
+        if len(holdcols) > 0:
+            self._fillColumns(final,holdcols,False,True)
+
+        if len(interpcols) > 0:
+            self._fillColumns(final,interpcols,True,True)
+
+        if autofill == True:
+            if len(contcols) > 0:
+                self._fillColumns(final,contcols,True,False,quiet=True)
+            final = final.bfill().ffill()
+
+        inst.Stage("fill",time.perf_counter() - stage)
         
         #Pad the start and end dates into the frame if not available
         if trim is not None:
+            stage = time.perf_counter()
                         
             rs = trim[0].replace(tzinfo=None,microsecond=0)
             re = trim[1].replace(tzinfo=None,microsecond=0)
@@ -646,35 +2014,942 @@ class AQLQuery:
             rs = self.ConvertTZDate(rs,serverzone,localzone)
             re = self.ConvertTZDate(re,serverzone,localzone)
 
-            trimmed = final[rs:re]
-            if len(trimmed.index) > 1:
-                
-                si = trimmed.index[0]
-                ei = trimmed.index[-1]
-
-                if si != rs:
-                    cols = []
-                    for cl in final.columns:
-                        cols.append(str(cl))
-                    dindex = pd.DatetimeIndex([rs])                
-                    mod = pd.DataFrame([final.iloc[0].values],index=dindex,columns=cols)                
-                    #trimmed = trimmed.append(mod)
-                    trimmed = pd.concat([trimmed,mod],axis=0)
-                    trimmed.sort_index(inplace=True)                
-
-                if ei != re:                
-                    cols = []
-                    for cl in final.columns:
-                        cols.append(str(cl))
-                    dindex = pd.DatetimeIndex([re])
-                    mod = pd.DataFrame([final.iloc[-1].values],index=dindex,columns=final.columns)
-                    #trimmed = trimmed.append(mod)            
-                    trimmed = pd.concat([trimmed,mod],axis=0)
-
-                final = trimmed
+            final = TrimFrame(final,rs,re)
+
+            inst.Stage("trim",time.perf_counter() - stage)
+
+        if compact == True:
+            final = self.CompactDataframe(final,results,namemap=namemap,float32=float32)
         
         return final
 
+    #Internal: Split the 'mapbad' and 'mapna' settings into per-column lookups -
+    # bad values, a constant to replace missing values with and a fill policy ('hold' or 'interp')
+    def _compileFill(self,mapbad,mapna):
+        badvalues = {}
+        constants = {}
+        policies = {}
+
+        if mapbad is not None:
+            for x in mapbad:
+                if x[0] not in badvalues:
+                    badvalues[x[0]] = []
+                badvalues[x[0]].append(x[1])
+
+        if mapna is not None:
+            for x in mapna:
+                if x[1] == 'hold' or x[1] == 'discrete':
+                    if x[0] not in policies:
+                        policies[x[0]] = 'hold'
+                elif x[1] == 'interp' or x[1] == 'cont':
+                    if x[0] not in policies:
+                        policies[x[0]] = 'interp'
+                elif x[0] not in constants:
+                    constants[x[0]] = x[1]
+
+        return badvalues, constants, policies
+
+    #Internal: The time index for a point's history, converted to the local timezone if one is given
+    def _pointIndex(self,p,serverzone,localzone):
+        if p.index is not None:
+            return pd.DatetimeIndex(p.index)
+        elif serverzone == None:
+            return pd.DatetimeIndex(p.times)
+        return pd.DatetimeIndex([self.ConvertTZString(i,serverzone,localzone) for i in p.times])
+
+    #Internal: Interpolate and/or back & forward fill a set of columns (by position) as a single block
+    def _fillColumns(self,frame,positions,interpolate,fill,quiet=False):
+        numeric = []
+        other = []
+        for p in positions:
+            if pd.api.types.is_numeric_dtype(frame.dtypes.iloc[p]):
+                numeric.append(p)
+            else:
+                other.append(p)
+
+        if len(numeric) > 0:
+            block = frame.iloc[:,numeric]
+            if interpolate == True:
+                block = block.interpolate()
+            if fill == True:
+                block = block.bfill().ffill()
+            for x in range(0,len(numeric)):
+                frame.isetitem(numeric[x],block.iloc[:,x])
+
+        #Columns holding text can't be interpolated as a block, so are handled one at a time
+        for p in other:
+            col = frame.iloc[:,p]
+            if interpolate == True:
+                if quiet == True:
+                    try:
+                        col = col.interpolate()
+                    except:
+                        pass
+                else:
+                    col = col.interpolate()
+            if fill == True:
+                col = col.bfill().ffill()
+            frame.isetitem(p,col)
+
+    #Look up the text for a single discrete value from an ARDI value map
+    def _mapText(self,mp,val):
+        try:
+            if type(mp) == list:
+                if val >= 0 and val < len(mp):
+                    return str(mp[val])
+            else:
+                if str(val) in mp:
+                    return str(mp[str(val)])
+        except:
+            pass
+        return str(val)
+
+    #Shrink a history data frame - mapped discrete columns become categoricals and analogue columns can be float32.
+    # Columns that are left as objects (ie. text that couldn't be converted to a number) are reported.
+    def CompactDataframe(self,frame,results,namemap=None,float32=False):
+        meta = {}
+        indx = -1
+        for p in AQLResult.From(results).Points():
+            indx = indx + 1
+            sname = p.Name()
+            if namemap is not None:
+                try:
+                    sname = namemap[indx]
+                except:
+                    pass
+            meta[sname] = p.record
+
+        objects = []
+        for col in frame.columns:
+            series = frame[col]
+            r = meta.get(col)
+            numeric = pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+            if not numeric:
+                if not isinstance(series.dtype,pd.CategoricalDtype):
+                    objects.append(col)
+                continue
+
+            if r is None:
+                continue
+
+            mp = r.get('map')
+            if r['type'] != 'MEASUREMENT' and mp is not None and len(mp) > 0:
+                #Turn discrete values into categories labelled from the value map
+                values = series.to_numpy(dtype=np.float64,na_value=np.nan)
+                valid = ~np.isnan(values)
+                uniq, inverse = np.unique(values[valid].astype(np.int64),return_inverse=True)
+                labels = [self._mapText(mp,int(u)) for u in uniq]
+                categories = list(dict.fromkeys(labels))
+                lookup = np.array([categories.index(l) for l in labels],dtype=np.int64)
+                codes = np.full(len(values),-1,dtype=np.int64)
+                codes[valid] = lookup[inverse]
+                frame[col] = pd.Categorical.from_codes(codes,categories=categories)
+            elif r['type'] == 'MEASUREMENT' and float32 == True:
+                frame[col] = series.astype(np.float32)
+
+        frame.attrs['objectcolumns'] = objects
+        if len(objects) > 0:
+            print("WARNING: Columns stored as objects (non-numeric values): " + ", ".join(str(x) for x in objects))
+
+        return frame
+
+#Maps history onto a fixed time grid. Each column is mapped in a single pass - the previous sample for every grid time is
+# found with searchsorted, then measurements are linearly interpolated and discrete values are held.
+class GridResampler:
+    def __init__(self,start,end,step):
+        if not isinstance(step,datetime.timedelta):
+            step = datetime.timedelta(seconds=step)
+        self.step = step
+        self.index = pd.date_range(start,end,freq=step)
+        self.grid = self.index.as_unit("ns").asi8
+
+    #Resample AQL history results (or a list of results, one per chunk) into a data frame indexed by the grid
+    def Resample(self,results,namemap=None,serverzone=None,localzone=None,mapbad=None,mapna=None,autofill=True,query=None):
+        if query is None:
+            query = AQLQuery(None)
+        if not isinstance(results,list):
+            results = [results]
+
+        inst = query._inst()
+        stage = time.perf_counter()
+
+        #Gather the samples for each point across all of the chunks
+        points = None
+        for result in results:
+            found = AQLResult.From(result).Points()
+            if points is None:
+                points = [[] for x in found]
+            for n, p in enumerate(found[0:len(points)]):
+                if p.times is None and p.index is None:
+                    continue
+                points[n].append(p)
+
+        badvalues, constants, policies = query._compileFill(mapbad,mapna)
+        names = []
+        columns = []
+        for n, parts in enumerate(points or []):
+            if len(parts) == 0:
+                continue
+            name = parts[0].Name()
+            if namemap is not None:
+                try:
+                    name = namemap[n]
+                except:
+                    pass
+
+            times = np.concatenate([query._pointIndex(p,serverzone,localzone).as_unit('ns').asi8 for p in parts])
+            values = np.concatenate([np.asarray(p.values) for p in parts])
+            if len(times) > 1 and (np.diff(times) < 0).any():
+                order = np.argsort(times,kind='stable')
+                times = times[order]
+                values = values[order]
+
+            if name in badvalues:
+                values = np.where(np.isin(values,badvalues[name]),np.nan,values)
+
+            method = policies.get(name)
+            fill = autofill or method is not None
+            if method is None:
+                method = 'interp' if parts[0].type == 'MEASUREMENT' else 'hold'
+            names.append(name)
+            columns.append((times,values,method,fill))
+
+        inst.Stage("decode",time.perf_counter() - stage)
+        stage = time.perf_counter()
+
+        #Numeric columns share one preallocated block - only text columns need their own storage
+        numeric = [n for n in range(0,len(columns)) if columns[n][1].dtype != object]
+        block = np.empty((len(self.grid),len(numeric)),dtype=float)
+        other = {}
+        for n, (times, values, method, fill) in enumerate(columns):
+            if n in numeric:
+                self._map(times,values,method,fill,block[:,numeric.index(n)])
+            else:
+                other[names[n]] = self._map(times,values,'hold',fill,np.empty(len(self.grid),dtype=object))
+
+        final = pd.DataFrame(block,index=self.index,columns=[names[n] for n in numeric],copy=False)
+        if len(other) > 0:
+            for name in other:
+                final[name] = other[name]
+            final = final[names]
+
+        for name in constants:
+            if name in final.columns:
+                final[name] = final[name].fillna(value=constants[name])
+
+        inst.Stage("resample",time.perf_counter() - stage)
+        return final
+
+    #Internal: Map one column onto the grid, writing the results into 'out'.
+    #When the column is filled (autofill, or it has its own fill policy), bad samples are skipped so the grid carries on
+    # from the good values either side, and grid times before the first sample take its value.
+    def _map(self,times,values,method,fill,out):
+        if fill:
+            good = pd.notna(values)
+            if not good.all():
+                times = times[good]
+                values = values[good]
+
+        if len(times) == 0:
+            out[:] = np.nan
+            return out
+
+        grid = self.grid
+        prev = np.searchsorted(times,grid,side='right') - 1
+        before = prev < 0
+        prev[before] = 0
+        out[:] = values[prev]
+
+        if method == 'interp' and len(times) > 1:
+            #Grid times that fall exactly on a sample take its value as it is
+            nxt = np.minimum(prev + 1,len(times) - 1)
+            inside = (nxt > prev) & ~before & (times[prev] != grid)
+            t0 = times[prev[inside]]
+            v0 = values[prev[inside]]
+            frac = (grid[inside] - t0) / (times[nxt[inside]] - t0)
+            out[inside] = v0 + (values[nxt[inside]] - v0) * frac
+
+        if not fill:
+            out[before] = np.nan
+        return out
+
+#A multi-resolution cache of history summaries, for trend displays that pan and zoom.
+#History is summarised (min, max, average) into buckets of base * 2^level seconds, and stored as tiles of a fixed number
+# of buckets. A view of any window is served from the level closest to the requested number of samples - coarser tiles are
+# built from finer ones when they're cached, and only missing tiles are fetched from the server.
+#Like AQL queries, tile times are in the server's own timezone.
+class TileCache:
+    def __init__(self,server,base=1,tilesize=256,oversample=4,size=4096):
+        self.server = server
+
+        #The finest bucket size (in seconds) and the number of buckets in each tile
+        self.base = base
+        self.tilesize = tilesize
+
+        #How many history samples to fetch for each bucket
+        self.oversample = oversample
+        self.mode = "interp"
+
+        #The maximum number of tiles to keep
+        self.size = size
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.built = 0
+        self.fetches = 0
+
+    #Forget all of the cached tiles
+    def Clear(self):
+        with self.lock:
+            self.tiles.clear()
+
+    #Return a summary of the history for a query between two times, with no more than 'samples' rows.
+    #The frame has a (name, statistic) column for the min, max and avg of each point, indexed by the start of each bucket.
+    def View(self,query,start,end,samples=1000):
+        start = pd.Timestamp(start).as_unit('ns')
+        end = pd.Timestamp(end).as_unit('ns')
+        window = (end - start).total_seconds()
+        level = 0
+        if window > self.base * samples:
+            level = int(np.ceil(np.log2(window / (self.base * samples))))
+
+        bucket = self._bucket(level)
+        span = bucket * self.tilesize
+        first = start.value // span
+        last = end.value // span
+        keys = [(query,level,n) for n in range(first,last + 1)]
+
+        tiles = {}
+        missing = []
+        for key in keys:
+            tile = self._get(key)
+            if tile is None and level > 0:
+                #If half of the tile is already cached at the next level down, only fetch the other half
+                children = [(query,level - 1,key[2] * 2),(query,level - 1,key[2] * 2 + 1)]
+                cached = [self._cached(c) for c in children]
+                if cached.count(True) == 1:
+                    child = children[cached.index(False)]
+                    self._fetch([child])
+                    tile = self._get(key)
+            if tile is None:
+                missing.append(key)
+            else:
+                tiles[key] = tile
+
+        #Fetch each run of consecutive missing tiles with a single request
+        run = []
+        for key in missing + [None]:
+            if key is not None and (len(run) == 0 or key[2] == run[-1][2] + 1):
+                run.append(key)
+                continue
+            if len(run) > 0:
+                tiles.update(self._fetch(run))
+            run = [key]
+
+        frame = self._assemble([tiles[k] for k in keys if k in tiles],keys[0][2] * span,bucket)
+        return frame[(frame.index >= start.floor(pd.Timedelta(bucket,'ns'))) & (frame.index <= end)]
+
+    #Internal: The width of a bucket at a level, in nanoseconds
+    def _bucket(self,level):
+        return int(self.base * 1000000000) * (2 ** level)
+
+    #Internal: True if a tile is in the cache
+    def _cached(self,key):
+        with self.lock:
+            return key in self.tiles
+
+    #Internal: Return a cached tile, building it from the level below if possible
+    def _get(self,key):
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+        query, level, n = key
+        if level == 0:
+            return None
+        with self.lock:
+            left = self.tiles.get((query,level - 1,n * 2))
+            right = self.tiles.get((query,level - 1,n * 2 + 1))
+        if left is None or right is None:
+            return None
+
+        #Each pair of neighbouring buckets in the children becomes one bucket in the parent
+        names = self._names([left,right])
+        stats = np.concatenate([self._align(left,names),self._align(right,names)],axis=2)
+        shape = (stats.shape[0],self.tilesize,2)
+        combined = np.empty((len(names),4,self.tilesize))
+        combined[:,0,:] = np.fmin.reduce(stats[:,0,:].reshape(shape),axis=2)
+        combined[:,1,:] = np.fmax.reduce(stats[:,1,:].reshape(shape),axis=2)
+        combined[:,2,:] = stats[:,2,:].reshape(shape).sum(axis=2)
+        combined[:,3,:] = stats[:,3,:].reshape(shape).sum(axis=2)
+        tile = (names,combined)
+        self.built += 1
+        self._put(key,tile)
+        return tile
+
+    #Internal: Keep a tile, dropping the least recently used tiles once the cache is full
+    def _put(self,key,tile):
+        with self.lock:
+            self.tiles[key] = tile
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.size:
+                self.tiles.popitem(last=False)
+
+    #Internal: Fetch the history for a run of consecutive tiles and summarise it into buckets
+    def _fetch(self,keys):
+        query, level, first = keys[0]
+        bucket = self._bucket(level)
+        span = bucket * self.tilesize
+        start = first * span
+        end = (keys[-1][2] + 1) * span
+        buckets = self.tilesize * len(keys)
+
+        req = AQLHistRequest(query)
+        req.SetRange(pd.Timestamp(start).to_pydatetime(),pd.Timestamp(end - 1000000000).to_pydatetime())
+        req.samples = buckets * self.oversample
+        req.mode = self.mode
+        req.autofill = False
+        frame = AQLQuery(self.server).GetHistory(req)
+        self.fetches += 1
+
+        names = list(frame.columns)
+        if len(frame.index) > 0 and isinstance(frame.index,pd.DatetimeIndex):
+            times = frame.index.as_unit('ns').asi8
+            values = frame.apply(pd.to_numeric,errors='coerce').to_numpy(dtype=float)
+        else:
+            #No history in the window - the tiles are empty
+            times = np.zeros(0,dtype='int64')
+            values = np.zeros((0,len(names)))
+        position = (times - start) // bucket
+        inside = (position >= 0) & (position < buckets)
+        position = position[inside]
+        values = values[inside]
+
+        stats = np.full((len(names),4,buckets),np.nan)
+        stats[:,2:4,:] = 0
+        if len(position) > 0:
+            order = np.argsort(position,kind='stable')
+            position = position[order]
+            values = values[order]
+            used, starts = np.unique(position,return_index=True)
+            finite = np.isfinite(values)
+            stats[:,0,used] = np.fmin.reduceat(values,starts,axis=0).T
+            stats[:,1,used] = np.fmax.reduceat(values,starts,axis=0).T
+            stats[:,2,used] = np.add.reduceat(np.where(finite,values,0),starts,axis=0).T
+            stats[:,3,used] = np.add.reduceat(finite.astype(float),starts,axis=0).T
+
+        #Tiles that aren't complete yet (they reach past the current time) are used but not kept.
+        now = self._now().value
+        tiles = {}
+        for n, key in enumerate(keys):
+            tile = (names,stats[:,:,n * self.tilesize:(n + 1) * self.tilesize].copy())
+            tiles[key] = tile
+            if (key[2] + 1) * span <= now:
+                self._put(key,tile)
+        return tiles
+
+    #Internal: The current time in the server's timezone (UTC if it isn't known), as a naive timestamp
+    def _now(self):
+        zone = None
+        if self.server is not None:
+            zone = self.server.timezone
+        if zone is None:
+            zone = pytz.utc
+        return pd.Timestamp.now(tz=zone).tz_localize(None).as_unit('ns')
+
+    #Internal: Join a list of consecutive tiles into a single summary frame
+    def _assemble(self,tiles,start,bucket):
+        if len(tiles) == 0:
+            return pd.DataFrame()
+        names = self._names(tiles)
+        stats = np.concatenate([self._align(t,names) for t in tiles],axis=2)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            avg = stats[:,2,:] / stats[:,3,:]
+        index = pd.DatetimeIndex(start + np.arange(stats.shape[2],dtype='int64') * bucket)
+
+        columns = {}
+        for n, name in enumerate(names):
+            columns[(name,'min')] = stats[n,0,:]
+            columns[(name,'max')] = stats[n,1,:]
+            columns[(name,'avg')] = avg[n]
+        return pd.DataFrame(columns,index=index)
+
+    #Internal: Every point name in a list of tiles, in the order they first appear
+    def _names(self,tiles):
+        names = []
+        for t in tiles:
+            for name in t[0]:
+                if name not in names:
+                    names.append(name)
+        return names
+
+    #Internal: The statistics of a tile with a row for each of the given names - points the tile doesn't have are empty
+    def _align(self,tile,names):
+        if tile[0] == names:
+            return tile[1]
+        stats = np.full((len(names),4,tile[1].shape[2]),np.nan)
+        stats[:,2:4,:] = 0
+        rows = { name: n for n, name in enumerate(tile[0]) }
+        for n, name in enumerate(names):
+            if name in rows:
+                stats[n] = tile[1][rows[name]]
+        return stats
+
+#Internal: Copy a numpy column into a new shared memory block, returning a (name,length,dtype) descriptor
+def _shareArray(arr):
+    #The block is handed to the parent process, which is responsible for removing it - so this process mustn't
+    # track it, or it is removed when the worker exits
+    try:
+        shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1),track=False)
+    except TypeError:
+        #Before Python 3.13 blocks are always tracked. POSIX blocks are tracked by their name with a leading slash.
+        shm = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+        if os.name == "posix":
+            resource_tracker.unregister("/" + shm.name,"shared_memory")
+    np.ndarray(arr.shape,dtype=arr.dtype,buffer=shm.buf)[:] = arr
+    shm.close()
+    return (shm.name,len(arr),arr.dtype.str)
+
+#Internal: Copy a column back out of shared memory and release the block
+def _unshareArray(desc):
+    shm = shared_memory.SharedMemory(name=desc[0])
+    try:
+        arr = np.ndarray((desc[1],),dtype=np.dtype(desc[2]),buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return arr
+
+#Internal: Runs in a worker process - decode a raw AQL history response, converting the timestamps and values
+# into numpy columns that are passed back through shared memory
+def _decodeHistory(content,serverzone,localzone):
+    converter = AQLQuery(None)
+    points = []
+    for p in AQLResult(json.loads(content)).Points():
+        record = dict(p.record)
+        record.pop('history',None)
+        if p.times is None:
+            points.append((record,None,None))
+            continue
+
+        if serverzone is None:
+            dindex = pd.DatetimeIndex(p.times)
+        else:
+            dindex = pd.DatetimeIndex([converter.ConvertTZString(i,serverzone,localzone) for i in p.times])
+
+        values = ('pickle',p.values)
+        if isinstance(p.values,np.ndarray) and p.values.dtype != object:
+            values = ('shared',_shareArray(p.values))
+        points.append((record,_shareArray(dindex.to_numpy()),values))
+    return points
+
+#Internal: Rebuild an AQLResult from the output of _decodeHistory
+def _attachHistory(decoded):
+    points = []
+    for record, index, values in decoded:
+        p = AQLPoint(record)
+        if index is not None:
+            p.index = _unshareArray(index)
+            if values[0] == 'shared':
+                p.values = _unshareArray(values[1])
+            else:
+                p.values = values[1]
+        points.append(p)
+
+    result = AQLResult({ 'results': [{ 'type': 'pointlist', 'value': [p.record for p in points] }] })
+    result.points = points
+    return result
+
+#Internal: Remove the shared memory blocks of a _decodeHistory result that won't be attached
+def _releaseHistory(decoded):
+    for record, index, values in decoded:
+        if index is None:
+            continue
+        descs = [index]
+        if values[0] == 'shared':
+            descs.append(values[1])
+        for desc in descs:
+            try:
+                shm = shared_memory.SharedMemory(name=desc[0])
+                shm.close()
+                shm.unlink()
+            except:
+                pass
+
+#Watches the history requests made to a server, and when they step through time at a regular interval (day by day,
+# or the same hour each day) fetches the next window in the background so it's ready when it's asked for.
+#Prefetched results are limited to a memory budget, and are discarded when the pattern breaks.
+class Prefetcher:
+    def __init__(self,server,budget=256*1024*1024,workers=2):
+        self.server = server
+        self.budget = budget
+        self.workers = workers
+        self.pool = None
+
+        #The last windows seen for each kind of request
+        self.windows = {}
+
+        #Prefetched (or in-progress) queries -> (future, pattern)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.prefetched = 0
+        self.hits = 0
+        self.discarded = 0
+
+    #Note a history request, and prefetch the next window if the requests form a pattern
+    def Observe(self,req):
+        pattern = (req.query,req.mode,req.samples,req.span,req.chunks,req.grid)
+        with self.lock:
+            history = self.windows.get(pattern,[])
+            history.append((req.sd,req.ed))
+            history = history[-3:]
+            self.windows[pattern] = history
+
+            step = self._step(history)
+            if step is None:
+                #The pattern has broken (or hasn't started) - anything prefetched for it won't be used
+                dropped = self._discard(pattern)
+        if step is None:
+            self._cancel(dropped)
+            return
+
+        nxt = copy.copy(req)
+        nxt.sd = req.sd + step
+        nxt.ed = req.ed + step
+        self._prefetch(pattern,[x[1] for x in nxt.Plan().Requests(nxt)])
+
+    #Return the prefetched result for a query (waiting for it if it's still being fetched), or None
+    def Take(self,query):
+        with self.lock:
+            entry = self.entries.pop(query,None)
+        if entry is None:
+            return None
+        try:
+            result = entry[0].result()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            return None
+        self.hits += 1
+        return result
+
+    #Cancel any prefetching and discard the results
+    def Close(self):
+        with self.lock:
+            dropped = [self._drop(query) for query in list(self.entries)]
+        self._cancel(dropped)
+        if self.pool is not None:
+            self.pool.shutdown(wait=False,cancel_futures=True)
+            self.pool = None
+
+    #The number of bytes of prefetched results being held
+    def Used(self):
+        with self.lock:
+            return self._used()
+
+    #Internal: The step between windows if the last windows form a pattern, otherwise None.
+    #Windows that follow on from each other are a pattern straight away - other steps have to repeat.
+    def _step(self,history):
+        if len(history) < 2:
+            return None
+        step = history[-1][0] - history[-2][0]
+        if step.total_seconds() <= 0 or history[-1][1] - history[-2][1] != step:
+            return None
+        if (history[-1][0] - history[-2][1]).total_seconds() in (0,1):
+            return step
+        if len(history) == 3 and history[-2][0] - history[-3][0] == step:
+            return step
+        return None
+
+    #Internal: Start fetching a set of queries in the background, if they fit in the budget
+    def _prefetch(self,pattern,queries):
+        started = []
+        with self.lock:
+            if self._used() >= self.budget:
+                return
+            if self.pool is None:
+                self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            for query in queries:
+                if query in self.entries:
+                    continue
+                future = self.pool.submit(AQLQuery(self.server)._execute,query,"bulk")
+                self.entries[query] = (future,pattern)
+                self.prefetched += 1
+                started.append(future)
+
+        #Callbacks run straight away for futures that have already finished, so they're added without the lock
+        for future in started:
+            future.add_done_callback(lambda f: self._trim())
+
+    #Internal: Drop the oldest finished results until the total is within the budget
+    def _trim(self):
+        dropped = []
+        with self.lock:
+            while self._used() > self.budget and len(self.entries) > 0:
+                dropped.append(self._drop(next(iter(self.entries))))
+        self._cancel(dropped)
+
+    #Internal: Discard everything prefetched for a pattern, returning the futures to cancel. The lock must be held.
+    def _discard(self,pattern):
+        return [self._drop(query) for query in [q for q in self.entries if self.entries[q][1] == pattern]]
+
+    #Internal: Discard a single prefetched query, returning its future. The lock must be held.
+    def _drop(self,query):
+        future = self.entries.pop(query)[0]
+        self.discarded += 1
+        return future
+
+    #Internal: Cancel discarded futures. Cancelling runs their callbacks, so the lock must not be held.
+    def _cancel(self,futures):
+        for future in futures:
+            future.cancel()
+
+    #Internal: The size of the finished results. The lock must be held.
+    def _used(self):
+        used = 0
+        for future, pattern in self.entries.values():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                used += future.result().nbytes
+        return used
+
+#The results of a federated history query
+class FederatedResponse:
+    def __init__(self):
+        #The merged frame - each column is prefixed with the name of the server it came from
+        self.frame = None
+
+        #The frame, error (if the query failed) and time taken (in seconds) for each server
+        self.frames = {}
+        self.errors = {}
+        self.timings = {}
+
+#Runs the same history request against several ARDI servers at once
+class Federation:
+    def __init__(self,servers,workers=None):
+        #Servers can be a list (named by their host) or a dictionary of name -> server
+        if isinstance(servers,dict):
+            self.servers = dict(servers)
+        else:
+            self.servers = {}
+            for srv in servers:
+                self.servers[srv.server] = srv
+        self.workers = workers
+        self.separator = " / "
+
+    #Get history from every server. The request's range is in its local zone (UTC by default) - it is converted into each
+    # server's timezone for the query, and the returned times are converted back.
+    def GetHistory(self,req):
+        response = FederatedResponse()
+        workers = self.workers
+        if workers is None:
+            workers = max(len(self.servers),1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for name in self.servers:
+                futures[name] = pool.submit(self._history,self.servers[name],req)
+
+            for name in self.servers:
+                frame, error, seconds = futures[name].result()
+                response.timings[name] = seconds
+                if error is not None:
+                    print("WARNING: History from " + name + " failed - " + error)
+                    response.errors[name] = error
+                else:
+                    response.frames[name] = frame
+
+        response.frame = self._merge(response.frames,req)
+        return response
+
+    #Internal: Get the history from a single server, returning (frame, error, seconds)
+    def _history(self,server,req):
+        start = time.perf_counter()
+        local = copy.copy(req)
+        if server.timezone is not None:
+            local.serverzone = server.timezone
+        if local.localzone is None:
+            local.localzone = pytz.utc
+        try:
+            #The range is in the local zone - each server is asked for the same instants in its own time
+            query = AQLQuery(server)
+            serverzone = local.serverzone
+            if serverzone is None:
+                serverzone = pytz.utc
+            local.sd = query.ConvertTZDate(req.sd,local.localzone,serverzone)
+            local.ed = query.ConvertTZDate(req.ed,local.localzone,serverzone)
+            frame = query.GetHistory(local)
+            return (frame, None, time.perf_counter() - start)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            return (None, str(sys.exc_info()[1]), time.perf_counter() - start)
+
+    #Internal: Join the frames from each server into a single wide frame
+    def _merge(self,frames,req):
+        parts = []
+        for name in frames:
+            frame = frames[name]
+            if frame is None or len(frame.columns) == 0:
+                continue
+            frame = frame[~frame.index.duplicated(keep='last')]
+            parts.append(frame.rename(columns=lambda c: name + self.separator + str(c)))
+
+        if len(parts) == 0:
+            return pd.DataFrame()
+
+        final = pd.concat(parts,axis=1,sort=True)
+        if req.autofill == True:
+            final = final.ffill()
+        return final
+
+#An out-of-band message from the consolidator (ie. an alarm or event).
+#Count is the number of identical messages merged into this one. Messages can also be read as [code,value].
+class Message:
+    __slots__ = ('code','value','received','count')
+
+    def __init__(self,code,value,received):
+        self.code = code
+        self.value = value
+        self.received = received
+        self.count = 1
+
+    def __getitem__(self,n):
+        return (self.code,self.value)[n]
+
+    def __len__(self):
+        return 2
+
+    def __repr__(self):
+        return str(self.code) + ": " + str(self.value)
+
+#Delivers out-of-band messages on their own thread, so floods of messages can't hold up live values.
+#Messages are filtered by code, repeats of the same message within 'window' seconds are merged, and the rest wait in
+# a bounded queue (the oldest are dropped when it is full) and are passed to the callback in batches.
+class MessagePipeline:
+    def __init__(self,callback,context=None,codes=None,maxqueue=10000,batch=500,interval=0.5,window=30):
+        self.callback = callback
+        self.context = context
+        self.maxqueue = maxqueue
+        self.batch = batch
+        self.interval = interval
+        self.window = window
+
+        self.exact = None
+        self.prefixes = []
+        if codes is not None:
+            self.Filter(codes)
+
+        self.queue = collections.deque()
+        self.recent = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+        self.received = 0
+        self.filtered = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    #Only pass on messages for these codes. Codes ending in '*' match any code starting with the rest. None passes everything.
+    def Filter(self,codes):
+        if codes is None:
+            self.exact = None
+            self.prefixes = []
+            return
+        self.exact = set(c for c in codes if not c.endswith("*"))
+        self.prefixes = tuple(c[:-1] for c in codes if c.endswith("*"))
+
+    #Queue a list of raw messages (dictionaries with 'code' and 'value') from the consolidator
+    def Put(self,messages):
+        now = time.time()
+        with self.condition:
+            if self.stopped:
+                return
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._deliver,daemon=True)
+                self.thread.start()
+
+            for itm in messages:
+                self.received += 1
+                code = itm['code']
+                if self.exact is not None and code not in self.exact and not (len(self.prefixes) > 0 and code.startswith(self.prefixes)):
+                    self.filtered += 1
+                    continue
+
+                key = (code,str(itm['value']))
+                previous = self.recent.get(key)
+                if previous is not None and now - previous.received < self.window:
+                    previous.count += 1
+                    self.duplicates += 1
+                    continue
+
+                msg = Message(code,itm['value'],now)
+                self.recent[key] = msg
+                if len(self.queue) >= self.maxqueue:
+                    self.queue.popleft()
+                    self.dropped += 1
+                self.queue.append(msg)
+
+            if len(self.queue) >= self.batch:
+                self.condition.notify()
+
+    #Stop the delivery thread, delivering anything still queued first if flush is set
+    def Stop(self,flush=True):
+        with self.condition:
+            self.stopped = True
+            if not flush:
+                self.queue.clear()
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.thread = None
+
+    #Counts of messages received, filtered out, merged as duplicates, dropped, delivered and still queued
+    def Stats(self):
+        with self.condition:
+            return { 'received': self.received,'filtered': self.filtered,'duplicates': self.duplicates,
+                     'dropped': self.dropped,'delivered': self.delivered,'queued': len(self.queue) }
+
+    #Internal: Delivery thread - passes queued messages to the callback in batches
+    def _deliver(self):
+        while True:
+            with self.condition:
+                if len(self.queue) < self.batch and not self.stopped:
+                    self.condition.wait(self.interval)
+                count = min(len(self.queue),self.batch)
+                batch = [self.queue.popleft() for x in range(0,count)]
+                finished = self.stopped and len(self.queue) == 0
+                self._expire()
+
+            if len(batch) > 0:
+                try:
+                    self.callback(batch,self.context)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    traceback.print_exc()
+                with self.condition:
+                    self.delivered += len(batch)
+
+            if finished:
+                return
+
+    #Internal: Forget messages that are too old to be merged with. The lock must be held.
+    def _expire(self):
+        if len(self.recent) < 1024:
+            return
+        cutoff = time.time() - self.window
+        for key in [k for k, m in self.recent.items() if m.received < cutoff]:
+            del self.recent[key]
+
 #Represents a live connection to ARDI data
 class Subscription:
     def __init__(self,core):
@@ -688,8 +2963,34 @@ class Subscription:
         self.context = None
         self.closed = False
 
-        self.mcallback = None
-        self.mcontext = None
+        #Out-of-band messages are passed to this MessagePipeline (see SetMessageCallback)
+        self.messages = None
+
+        #Reconnection - delays (in seconds) double on each consecutive failure up to maxdelay.
+        #Set maxretries to give up after that many consecutive failures (None retries forever).
+        self.retrydelay = 1
+        self.maxdelay = 30
+        self.maxretries = None
+        self.failures = 0
+        self.resubscribes = 0
+
+        #Gap backfill - after an outage, missed values are read from history and delivered before live data resumes.
+        self.backfill = True
+        self.maxbackfill = 60*60*24
+        self.backfilled = 0
+
+        #The number of assets read by each backfill query
+        self.backfillbatch = 100
+
+        #The time of the last successful poll, and the start of the current outage (if any)
+        self.lastupdate = None
+        self.outage = None
+
+        #The timestamp of the values being delivered to the callback - None for live values
+        self.timestamp = None
+
+        #Sinks (such as a Recorder) that receive every update as well as the callback
+        self.sinks = []
 
     #Adds a new ARDI point to the subscription
     def AddCode(self,address):
@@ -703,6 +3004,8 @@ class Subscription:
     #Disconnect from live data
     def Disconnect(self):
         self.cancelled = True
+        if self.messages is not None:
+            self.messages.Stop()
 
     #Internal: Initial live data subscription
     def Subscribe(self):
@@ -718,10 +3021,20 @@ class Subscription:
         self.callback = call
         self.context = cont
 
-    #Set the callback for OOB messages
-    def SetMessageCallback(self,call,cont):
-        self.mcallback = call
-        self.mcontext = cont
+    #Add a sink - any object with a Record(updates,timestamp) function - that receives all updates
+    def AddSink(self,sink):
+        self.sinks.append(sink)
+
+    #Set the callback for OOB messages. It is called on its own thread with lists of Message objects.
+    #Codes optionally limits the messages to those codes (see MessagePipeline.Filter).
+    def SetMessageCallback(self,call,cont,codes=None):
+        self.SetMessagePipeline(MessagePipeline(call,cont,codes=codes))
+
+    #Use a MessagePipeline (or None) for OOB messages
+    def SetMessagePipeline(self,pipeline):
+        if self.messages is not None:
+            self.messages.Stop()
+        self.messages = pipeline
 
     #Internal: Unsubscribe from live data
     def Unsubscribe(self):
@@ -739,137 +3052,235 @@ class Subscription:
     def Update(self):
         if self.codechange == True:
             self.Unsubscribe()
-            self.Subscribe()
-            return
-        self._call("update")
-        pass
+            return self.Subscribe()
+        return self._call("update")
+
+    #Internal: The URL of the consolidator for a given live data function
+    def _url(self,function):
+        fullurl = self.core.server
+        ps = fullurl.find(':')
+        if ps > -1:
+            fullurl = fullurl[0:ps]
+
+        ps = fullurl.find('/')
+        if ps > -1:
+            fullurl = fullurl[0:ps]
+
+        return "http://" + fullurl + ":" + str(self.core.contexts[0].consolidator) + "/" + function
+
+    #Internal: Note that the subscription has been lost, so the next poll re-subscribes and backfills the gap.
+    def _lost(self):
+        if self.outage is None:
+            self.outage = self.lastupdate
+        if self.subscription != "":
+            self.resubscribes += 1
+        self.subscription = ""
     
     #Handle the long-polling request for live data
     def _call(self,function):
         
-        if (len(self.codes) and self.mcallback is None):
+        if len(self.codes) == 0 and self.messages is None:
             time.sleep(1)
-            return
+            return False
 
-        try:            
-            fullurl = self.core.server
-            try:
-                ps = fullurl.index(':')
-                if ps > -1:
-                    fullurl = fullurl[0:ps]
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except:
-                pass
+        try:
+            fullurl = self._url(function)
+            if function == "subscribe":                    
+                r = self.core._request("POST",fullurl,"subscription." + function,data={'codes': ",".join(self.codes),'format': 'json' }, timeout=5)
+            else:
+                r = self.core._request("POST",fullurl,"subscription." + function,data={'id': self.subscription,'format': 'json' }, timeout=30)
+        except (KeyboardInterrupt, SystemExit):
+            self.cancelled = True
+            return False
+        except:
+            print("WARNING: Live data " + function + " failed - " + str(sys.exc_info()[1]))
+            if function != "unsubscribe":
+                self.failures += 1
+                self._lost()
+            return False
 
-            try:
-                ps = fullurl.index('/')
-                if ps > -1:
-                    fullurl = fullurl[0:ps]
-            except (KeyboardInterrupt, SystemExit):
-                raise
-            except:
-                pass            
-
-            fullurl = "http://" + fullurl
-            fullurl += ":" + self.core.contexts[0].consolidator
-            fullurl += "/" + function
-
-            if self.core.prefix == "https://":
-                #Use HTTPS Proxy
-                addr = "https://" + self.core.servername + "/data/livedata?format=json&port=" + this.dataport + "&action=" + function;                            
-
-            anydata = False
-            post_data = {}
-            if function != "subscribe":
-                post_data['id'] = self.subscription
-                anydata = True
-
-            if function == "subscribe":                
-                codelist = ""
-                for itm in self.codes:                    
-                    if codelist != "":
-                        codelist = codelist + ","
-                    codelist += itm
-                    anydata = True
-                post_data['codes'] = codelist
-                anydata = True
-
-            if anydata == True:
-                postfields = urlencode(post_data)
-            try:
-                
-                if function == "subscribe":                    
-                    r = requests.post(fullurl,data={'codes': codelist,'format': 'json' }, timeout=5)                    
-                else:
-                    r = requests.post(fullurl,data={'id': self.subscription,'format': 'json' }, timeout=30)                
+        if function == "unsubscribe":
+            return True
+
+        try:
+            js = r.json()
+            subid = js['id']
+        except:
+            #The consolidator no longer recognises our subscription (it may have restarted) - subscribe again on the next poll.
+            self.failures += 1
+            self._lost()
+            return False
+
+        self.subscription = subid
+        self.failures = 0
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+        if self.outage is not None:
+            since = self.outage
+            self.outage = None
+            if self.backfill == True and (self.callback is not None or len(self.sinks) > 0):
+                self._backfill(since,now)
+        self.lastupdate = now
+
+        returned = {}
+        for itm in js.get('items',[]):
+            returned[itm['code']] = itm['value']
+                           
+        if len(returned) > 0:
+            self.timestamp = None
+            self._deliver(returned)
+
+        if self.messages is not None:
+            messages = js.get('messages')
+            if messages:
+                self.messages.Put(messages)
                 
-                returned = {}
+        return True
 
-                js = {}
-                try:
-                    js = r.json()
-                except:
-                    if function != "subscribe":
-                        self._call("subscribe")
-                        return True
-                    
-                self.subscription = js['id']
+    #Internal: Read the values missed during an outage from history and deliver them, oldest first.
+    def _backfill(self,start,end):
+        if start is None or len(self.codes) == 0:
+            return
 
-                for itm in js['items']:
-                    cd = itm['code']                    
-                    returned[cd] = itm['value']
-                                   
-                if self.callback is not None:
-                    self.callback(returned,self.context)            
+        if (end - start).total_seconds() > self.maxbackfill:
+            print("WARNING: Live data outage longer than " + str(self.maxbackfill) + " seconds - only the most recent values will be backfilled")
+            start = end - datetime.timedelta(seconds=self.maxbackfill)
 
-                if self.mcallback is not None:
-                    returned = []                
-                    for itm in js['messages']:
-                        returned.append([itm['code'],itm['value']])
+        #Codes are asset:property:node - the node only picks which value of the property is live, so history is per
+        # asset and property. The assets for each property are read in batches, one history query per batch.
+        points = collections.OrderedDict()
+        for code in self.codes:
+            parts = code.split(":")
+            if len(parts) < 2:
+                continue
+            points.setdefault((parts[0],parts[1]),[]).append(code)
 
-                    try:
-                        self.mcallback(returned,self.mcontext)
-                    except:
-                        pass
-                    
-            except (KeyboardInterrupt, SystemExit):
-                self.cancelled = True
-                return False
+        properties = collections.OrderedDict()
+        for asset, prop in points.keys():
+            properties.setdefault(prop,[]).append(asset)
+
+        query = AQLQuery(self.core)
+        events = []
+        for prop, assets in properties.items():
+            for pos in range(0,len(assets),self.backfillbatch):
+                batch = assets[pos:pos + self.backfillbatch]
+                try:
+                    req = AQLHistRequest(query.PointQuery("'" + ",".join(batch) + "'",prop,"VALUES {} GETHISTORY"))
+                    req.SetRange(start,end)
+                    req.Raw()
+                    for result in query._historyResults(req,[x[1] for x in query._historyQueries(req)]):
+                        for p in result.Points():
+                            codes = points.get((str(p.sourceid),str(p.propid)))
+                            if codes is None:
+                                continue
+                            if p.times is None:
+                                continue
+                            for stamp, value in zip(p.times,p.values):
+                                tm = datetime.datetime.strptime(stamp[0:19],"%Y-%m-%d %H:%M:%S")
+                                if tm > start and tm <= end:
+                                    #Values are delivered as text, like live values
+                                    for code in codes:
+                                        events.append((tm,code,_sampleText(value)))
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    print("WARNING: Unable to backfill " + str(len(batch)) + " assets of property " + prop + " - " + str(sys.exc_info()[1]))
+
+        #Deliver each timestamp as its own update, in time order
+        events.sort(key=lambda x: x[0])
+        pos = 0
+        while pos < len(events):
+            tm = events[pos][0]
+            returned = {}
+            while pos < len(events) and events[pos][0] == tm:
+                returned[events[pos][1]] = events[pos][2]
+                pos += 1
+            self.timestamp = tm
+            self._deliver(returned)
+            self.backfilled += len(returned)
+        self.timestamp = None
+
+    #Internal: Pass a set of updates to the sinks and the callback
+    def _deliver(self,returned):
+        for sink in self.sinks:
+            try:
+                sink.Record(returned,self.timestamp)
+            except:
+                traceback.print_exc()
+        if self.callback is not None:
+            try:
+                self.callback(returned,self.context)
             except:
-                print("Failed To Send!")
                 traceback.print_exc()
-                return False
-            return True
-        
-        except:
-            traceback.print_exc()
-            return False
+
+    #Internal: How long to wait before the next attempt, given the number of consecutive failures
+    def _delay(self):
+        if self.failures == 0:
+            return 0
+        return min(self.retrydelay * (2 ** (self.failures - 1)),self.maxdelay)
 
     #Main thread body
     def ThreadBody(self):
         while self.cancelled == False:
-            while self.subscription == "":
-                if self.Subscribe() == False:
-                    try:
-                        time.sleep(5)
-                    except:
-                        self.cancelled = True
-                    if self.cancelled == True:
-                        break;
-                else:
-                    break
+            if self.maxretries is not None and self.failures > self.maxretries:
+                print("WARNING: Live data connection failed " + str(self.failures) + " times in a row - giving up")
+                self.cancelled = True
+                break
+
+            try:
+                time.sleep(self._delay())
+            except:
+                self.cancelled = True
             if self.cancelled == True:
-                break;
+                break
+
+            if self.subscription == "":
+                self.Subscribe()
+                continue
 
             if self.Update():
-                #Call the callback function with our new data...                
+                #Long-polls return as soon as data arrives - give the consolidator time to collect more
                 time.sleep(1)
-                pass
             else:
-                #No new data arrived - immediately try again.
+                #No new data arrived - try again shortly.
                 time.sleep(0.5)
+
+#Internal: A live value as a float, or NaN if it isn't a number
+def _number(value):
+    try:
+        return float(value)
+    except:
+        return np.nan
+
+#Limits how often a live channel reports new values.
+#Analogue channels report when they move by more than the deadband - an absolute amount, or a percentage of the channel's min/max range.
+#Discrete channels (and analogue channels if 'changes' is True) only report when the value changes.
+#Interval is the minimum number of seconds between reports.
+class ChannelFilter:
+    def __init__(self,deadband=None,percent=None,interval=None,changes=None):
+        self.deadband = deadband
+        self.percent = percent
+        self.interval = interval
+        self.changes = changes
+
+    #The minimum change before an analogue channel reports
+    def Threshold(self,channel):
+        threshold = 0
+        if self.deadband is not None:
+            threshold = self.deadband
+        if self.percent is not None:
+            try:
+                span = abs(float(channel.properties['max']) - float(channel.properties['min']))
+                threshold = max(threshold,span * self.percent / 100)
+            except:
                 pass
+        return threshold
+
+    #True if the channel should only report changed values
+    def ChangesOnly(self,channel):
+        if self.changes is None:
+            return channel.IsDiscrete()
+        return self.changes
 
 #Represents a single ARDI live channel
 class Channel:
@@ -878,11 +3289,26 @@ class Channel:
         self.type = ""
         self.code = ""
         self.value = None
+        self.timestamp = None
         self.properties = {}
         self.session = session
 
-    def SetValue(self,val):        
+    #Set the channel value. Timestamp is only given for values recovered from history after an outage.
+    def SetValue(self,val,timestamp=None):        
         self.value = val
+        self.timestamp = timestamp
+
+    #Set (or with None, remove) the filter for this channel
+    def SetFilter(self,flt):
+        self.filters = flt
+        if self.session is not None:
+            self.session.filterstate = None
+
+    #True if the channel has discrete (status, enum or text) values rather than measurements
+    def IsDiscrete(self):
+        if self.type != "":
+            return self.type != "MEASUREMENT"
+        return not self.code.endswith(":measurement")
 
     def AsText(self):
         return str(self.value)
@@ -905,6 +3331,10 @@ class Session:
         self.mapping = {}
         self.subscription = None
         self.callbackfunction = None
+        self.sinks = []
+
+        #Compiled channel filters - rebuilt whenever a filter changes
+        self.filterstate = None
 
     #Add an individual channel by name and property
     def AddChannel(self,asset,prop=None):
@@ -912,7 +3342,7 @@ class Session:
         if prop is None:
             channels = [self._getChannelForNode(asset)]
         else:
-            js = query.Execute("'" + asset + "' ASSET '" + prop + "' PROPERTY VALUES")
+            js = query.Query("'" + asset + "' ASSET '" + prop + "' PROPERTY VALUES")
             channels = self._getChannelsFromAQL(js)
 
         if len(channels) > 0:
@@ -922,9 +3352,15 @@ class Session:
         else:
             return None
 
+    #Add an individual channel by asset ID and property (ID or name)
     def AddPoint(self,asset,prop):
         query = AQLQuery(self.server)
-        js = query.Execute(str(asset) + " ASSETBYID " + str(prop) + " PROPERTYBYID VALUES")
+        try:
+            aql = query.PointQuery(asset,prop)
+        except ValueError as e:
+            print(str(e))
+            return None
+        js = query.Query(aql)
         channels = self._getChannelsFromAQL(js)
         if len(channels) > 0:
             channel = channels[0]
@@ -943,7 +3379,7 @@ class Session:
         assetid = bits[0]
         prop = bits[1]        
         query = AQLQuery(self.server)
-        js = query.Execute(str(assetid) + " ASSETBYID " + str(prop) + " PROPERTYBYID VALUES")
+        js = query.Query(query.PointQuery(assetid,prop))
         points = self._extractPointsFromAQL(js)        
         return self._getChannelsForPoints(points)[0]        
 
@@ -954,6 +3390,7 @@ class Session:
             chan = Channel(self)
             chan.name = pnt['name'] + " " + pnt['propname']
             chan.value = pnt['value']
+            chan.type = pnt['type']
             if pnt['type'] == 'MEASUREMENT':
                 node = "measurement"
                 chan.properties["min"] = pnt['min']
@@ -977,36 +3414,109 @@ class Session:
         return channels
 
     def _extractPointsFromAQL(self,dct):
-        points = []
-        #print("Dictionary: " + str(dct))
-        for reslist in dct['results']:
-            if reslist['type'] != 'pointlist':
-                continue
-            for pnt in reslist['value']:
-                points.append(pnt)
-        return points
+        return [p.record for p in AQLResult.From(dct).Points()]
 
     def _dataupdates(self,updates,context):
         updated = []
-        #print("New Data Updates Arrived: " + str(updates))
+        timestamp = None
+        if self.subscription is not None:
+            timestamp = self.subscription.timestamp
+
+        channels = []
+        values = []
         for x in updates:
-            try:
-                #print("Searching For " + x + " in" + str(self.mapping))
-                for q in self.mapping[x]:
-                    q.SetValue(updates[x])
-                for v in self.mapping[x]:
-                    updated.append(v)
-            except:
-                traceback.print_exc()
-                pass
+            for q in self.mapping.get(x,[]):
+                channels.append(q)
+                values.append(updates[x])
+
+        if len(channels) == 0:
+            return
+
+        keep = self._filter(channels,values,timestamp)
+        for n in range(0,len(channels)):
+            if keep is None or keep[n]:
+                channels[n].SetValue(values[n],timestamp)
+                updated.append(channels[n])
+
         if len(updated) > 0:
             if self.callbackfunction != None:
                 self.callbackfunction(updated)
 
+    #Set the filter for a list of channels (or all channels in the session)
+    def SetFilter(self,flt,channels=None):
+        if channels is None:
+            channels = self.channels
+        for chan in channels:
+            chan.filters = flt
+        self.filterstate = None
+
+    #Internal: Build arrays of the filter settings & last reported values for the filtered channels
+    def _compileFilters(self):
+        filtered = [c for c in self.channels if c.filters is not None]
+        state = {}
+        state['position'] = {id(c): n for n, c in enumerate(filtered)}
+        state['threshold'] = np.array([c.filters.Threshold(c) for c in filtered],dtype=float)
+        state['interval'] = np.array([c.filters.interval or 0 for c in filtered],dtype=float)
+        state['changes'] = np.array([c.filters.ChangesOnly(c) for c in filtered],dtype=bool)
+        state['analogue'] = np.array([not c.IsDiscrete() for c in filtered],dtype=bool)
+        state['lastvalue'] = np.full(len(filtered),np.nan)
+        state['lasttext'] = np.full(len(filtered),None,dtype=object)
+        state['lasttime'] = np.full(len(filtered),-np.inf)
+        self.filterstate = state
+
+    #Internal: Decide which of a batch of channel updates pass their filters. Returns None if nothing is filtered.
+    def _filter(self,channels,values,timestamp):
+        if self.filterstate is None:
+            if not any(c.filters is not None for c in self.channels):
+                return None
+            self._compileFilters()
+        state = self.filterstate
+        if len(state['position']) == 0:
+            return None
+
+        position = state['position']
+        pos = np.array([position.get(id(c),-1) for c in channels])
+        filtered = pos >= 0
+        keep = np.ones(len(channels),dtype=bool)
+        if not filtered.any():
+            return keep
+
+        idx = pos[filtered]
+        texts = np.array([str(v) for v in values],dtype=object)[filtered]
+        numbers = np.array([_number(v) for v in values],dtype=float)[filtered]
+        if timestamp is None:
+            now = time.time()
+        else:
+            now = timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+        lastvalue = state['lastvalue'][idx]
+        threshold = state['threshold'][idx]
+        changes = state['changes'][idx]
+
+        analogue = state['analogue'][idx]
+
+        #Text comparison for discrete channels & non-numeric values (such as bad quality), deadband comparison for analogue numbers
+        textpass = (texts != state['lasttext'][idx]) | (~changes & ~analogue)
+        with np.errstate(invalid='ignore'):
+            moved = np.abs(numbers - lastvalue)
+            numberpass = (moved > threshold) | ((threshold == 0) & ~changes)
+        numeric = analogue & ~np.isnan(numbers) & ~np.isnan(lastvalue)
+        passed = np.where(numeric,numberpass,textpass)
+        passed &= (now - state['lasttime'][idx]) >= state['interval'][idx]
+
+        #Remember what was reported for the next comparison
+        reported = idx[passed]
+        state['lastvalue'][reported] = numbers[passed]
+        state['lasttext'][reported] = texts[passed]
+        state['lasttime'][reported] = now
+
+        keep[filtered] = passed
+        return keep
+
     #Add multiple channels by AQL query
     def AddChannels(self,qry):
         query = AQLQuery(self.server)
-        js = query.Execute(qry)
+        js = query.Query(qry)
 
         channels = self._getChannelsFromAQL(js)        
 
@@ -1019,8 +3529,18 @@ class Session:
 
     #Add multiple channels from a list of 'Asset.Property' strings
     def AddChannelList(self,lst):
+        channels = self._lookupChannels(lst)
+
+        for q in channels:        
+            #print("Adding " + str(q.name) + " / " + str(q.code))
+            self.channels.append(q)           
+
+        return channels
+
+    #Internal: Look up channels from a list of 'Asset.Property' strings
+    def _lookupChannels(self,lst):
         url = self.server.Endpoint() + "/api/lookuppoints"
-        resp = requests.post(url,{"points": ";".join(lst), "format": "json"})
+        resp = self.server._request("POST",url,"lookuppoints",data={"points": ";".join(lst), "format": "json"})
 
         #print("Lookup Results: " + resp.text)
         dta = json.loads(resp.text)
@@ -1031,6 +3551,8 @@ class Session:
             chan.name = pnt['name']
             chan.value = 0
             chan.code = pnt['code']
+            if 'type' in pnt:
+                chan.type = pnt['type']
             if 'min' in pnt:
                 chan.properties["min"] = pnt['min']
             if 'max' in pnt:
@@ -1040,14 +3562,93 @@ class Session:
             
             channels.append(chan)
 
-        for q in channels:        
-            #print("Adding " + str(q.name) + " / " + str(q.code))
-            self.channels.append(q)           
-
         return channels
 
+    #Read the current values of many points at once, without starting the session.
+    #Points can be an AQL query, or a list of point codes (asset:property:node) and/or 'Asset.Property' names.
+    #Names and codes are resolved and read in batches, several at a time.
+    #Returns a data frame with one row per point - code, type, value (NaN if not numeric), text, units, min and max.
+    def Snapshot(self,points,batch=500,workers=4):
+        if isinstance(points,str):
+            #AQL results already include the current values
+            channels = self._getChannelsFromAQL(AQLQuery(self.server).Query(points))
+        else:
+            codes = []
+            names = []
+            for pnt in points:
+                bits = pnt.split(":")
+                if len(bits) == 3 and bits[0].isdigit() and bits[1].isdigit():
+                    codes.append(pnt)
+                else:
+                    names.append(pnt)
+            batches = [names[n:n+batch] for n in range(0,len(names),batch)]
+            codes = [self._codeChannel(c) for c in codes]
+            channels = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for found in pool.map(self._lookupChannels,batches):
+                    channels.extend(found)
+            channels = channels + codes
+
+            #Looked up channels & raw codes need their values read from the consolidator
+            live = [c.code for c in channels if c.code != ""]
+            batches = [live[n:n+batch] for n in range(0,len(live),batch)]
+            values = {}
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for found in pool.map(self._readCodes,batches):
+                    values.update(found)
+            for chan in channels:
+                if chan.code in values:
+                    chan.value = values[chan.code]
+                elif chan.code != "":
+                    chan.value = None
+
+        return self._snapshotFrame(channels)
+
+    #Internal: A channel with no metadata for a raw point code
+    def _codeChannel(self,code):
+        chan = Channel(self)
+        chan.name = code
+        chan.code = code
+        if code.endswith(":measurement"):
+            chan.type = "MEASUREMENT"
+        return chan
+
+    #Internal: Read the current values of a list of point codes with a single subscribe/unsubscribe
+    def _readCodes(self,codes):
+        values = {}
+        sub = Subscription(self.server)
+        sub.codes = list(codes)
+        sub.backfill = False
+        sub.SetCallback(lambda updates, context: values.update(updates),None)
+        if sub.Subscribe():
+            sub.Unsubscribe()
+        else:
+            print("WARNING: Unable to read current values for " + str(len(codes)) + " points")
+        return values
+
+    #Internal: Build the snapshot table from a list of channels
+    def _snapshotFrame(self,channels):
+        def prop(chan,name):
+            return _number(chan.properties.get(name))
+
+        text = np.array([None if c.value is None else str(c.value) for c in channels],dtype=object)
+        frame = pd.DataFrame({
+            'code': np.array([c.code for c in channels],dtype=object),
+            'type': np.array([c.type for c in channels],dtype=object),
+            'value': np.array([_number(c.value) for c in channels],dtype=float),
+            'text': text,
+            'units': np.array([c.properties.get('units') for c in channels],dtype=object),
+            'min': np.array([prop(c,'min') for c in channels],dtype=float),
+            'max': np.array([prop(c,'max') for c in channels],dtype=float)
+            },index=pd.Index([c.name for c in channels],name='name'))
+        return frame
+
     def Callback(self,func):
         self.callbackfunction = func
+
+    #Add a sink (such as a Recorder) that receives every update for the session's channels
+    def AddSink(self,sink):
+        self.sinks.append(sink)
         
     #Connect and start processing
     def Start(self):
@@ -1060,6 +3661,11 @@ class Session:
                     self.mapping[n.code] = []
                 self.mapping[n.code].append(n)
 
+        for sink in self.sinks:
+            if hasattr(sink,"SetNames"):
+                sink.SetNames({n.code: n.name for n in self.channels if n.code != ""})
+            self.subscription.AddSink(sink)
+
         self.subscription.SetCallback(self._dataupdates,None)
         self.subscription.Connect()        
         return True
@@ -1069,3 +3675,312 @@ class Session:
         if self.subscription is not None:
             self.subscription.Disconnect()
             self.subscription = None
+
+#Recorded live data is appended to segment files in column blocks, one block per flush. Each block is a header (the
+# number of values, and the first and last time in the block) followed by the time, value, code and text columns.
+#The time is nanoseconds since the epoch (UTC), and the code and any text value are indexes into the tables in the
+# recording's index file. Blocks are always a multiple of 8 bytes, so every column is aligned.
+BLOCK = [('count','<i8'),('first','<i8'),('last','<i8')]
+COLUMNS = [('time','<i8'),('value','<f8'),('code','<u4'),('text','<i4')]
+
+#A single recorded value, as returned by Recording.Records
+RECORD = [('code','<u4'),('time','<i8'),('value','<f8'),('text','<i4')]
+
+#A Subscription/Session sink that records live data to disk.
+#Updates are buffered in memory and appended in batches to segment files in a folder, which are rotated by size or age.
+class Recorder:
+    def __init__(self,path,flushsize=10000,flushinterval=5,rotatesize=5000000,rotateinterval=60*60*24,keep=None):
+        self.path = path
+        
+        #Flush once this many values are waiting, or this many seconds have passed since the last flush
+        self.flushsize = flushsize
+        self.flushinterval = flushinterval
+
+        #Start a new segment once the current one has this many records or is this many seconds old.
+        #If keep is set, only that many segments are kept - older ones are deleted.
+        self.rotatesize = rotatesize
+        self.rotateinterval = rotateinterval
+        self.keep = keep
+
+        #Buffered values are kept as columns, and only converted to records when they are flushed
+        self.lock = threading.Lock()
+        self.buffer = ([],[],[],[])
+        self.count = 0
+        self.lastflush = time.time()
+        self.written = 0
+
+        self.segment = None
+        self.segmentsize = 0
+        self.segmentstart = 0
+        self.segmentrange = None
+
+        os.makedirs(path,exist_ok=True)
+        index = Recording(path).Index()
+        self.codes = index['codes']
+        self.names = index['names']
+        self.strings = index['strings']
+        self.segments = index['segments']
+        self.codeids = {c: n for n, c in enumerate(self.codes)}
+        self.stringids = {s: n for n, s in enumerate(self.strings)}
+        self.changed = False
+
+    #Set the human-readable names to use for point codes when the recording is loaded
+    def SetNames(self,names):
+        with self.lock:
+            for code in names:
+                if self.names.get(code) != names[code]:
+                    self.names[code] = names[code]
+                    self.changed = True
+
+    #Record a set of updates - a dictionary of code -> value. Timestamp is a UTC time, or None for 'now'.
+    def Record(self,updates,timestamp=None):
+        if timestamp is None:
+            stamp = time.time_ns()
+        else:
+            stamp = int(pd.Timestamp(timestamp).value)
+            
+        with self.lock:
+            codes, times, values, texts = self.buffer
+            for code in updates:
+                codes.append(self._code(code))
+                times.append(stamp)
+
+                value = updates[code]
+                try:
+                    values.append(float(value))
+                    texts.append(-1)
+                except:
+                    values.append(float('nan'))
+                    texts.append(self._string(str(value)))
+            self.count += len(updates)
+
+            if self.count >= self.flushsize or time.time() - self.lastflush >= self.flushinterval:
+                self._flush()
+
+    #Write any buffered values to disk
+    def Flush(self):
+        with self.lock:
+            self._flush()
+
+    #Start a new segment file
+    def Rotate(self):
+        with self.lock:
+            self._flush()
+            self._endSegment()
+
+    #Flush and close the recording
+    def Close(self):
+        self.Rotate()
+
+    #Internal: Look up (or allocate) the ID for a point code
+    def _code(self,code):
+        cid = self.codeids.get(code)
+        if cid is None:
+            cid = len(self.codes)
+            self.codes.append(code)
+            self.codeids[code] = cid
+            self.changed = True
+        return cid
+
+    #Internal: Look up (or allocate) the ID for a text value
+    def _string(self,text):
+        sid = self.stringids.get(text)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(text)
+            self.stringids[text] = sid
+            self.changed = True
+        return sid
+
+    #Internal: Write the buffer to the current segment. The lock must be held.
+    def _flush(self):
+        self.lastflush = time.time()
+        if self.count == 0:
+            return
+
+        #The index is written first, so any codes or strings in the data are always present when it is read
+        if self.changed == True:
+            self._writeIndex()
+
+        if self.segment is None or self.segmentsize >= self.rotatesize or self.lastflush - self.segmentstart >= self.rotateinterval:
+            self._startSegment()
+
+        codes, times, values, texts = self.buffer
+        times = np.array(times,dtype='<i8')
+        header = np.array([(self.count,times.min(),times.max())],dtype=BLOCK)
+        with open(self.segment,"ab") as fl:
+            fl.write(header.tobytes())
+            fl.write(times.tobytes())
+            fl.write(np.array(values,dtype='<f8').tobytes())
+            fl.write(np.array(codes,dtype='<u4').tobytes())
+            fl.write(np.array(texts,dtype='<i4').tobytes())
+
+        if self.segmentrange is None:
+            self.segmentrange = [int(header['first'][0]),int(header['last'][0])]
+        else:
+            self.segmentrange = [min(self.segmentrange[0],int(header['first'][0])),max(self.segmentrange[1],int(header['last'][0]))]
+
+        self.segmentsize += self.count
+        self.written += self.count
+        self.buffer = ([],[],[],[])
+        self.count = 0
+
+    #Internal: Begin a new segment file, removing old segments if required. The lock must be held.
+    def _startSegment(self):
+        self._endSegment()
+        self.segmentstart = self.lastflush
+        self.segmentsize = 0
+        self.segment = os.path.join(self.path,"segment-" + str(time.time_ns()) + ".seg")
+
+        if self.keep is not None:
+            segments = Recording(self.path).Segments()
+            for old in segments[0:max(len(segments) - self.keep + 1,0)]:
+                try:
+                    os.remove(old)
+                    if self.segments.pop(os.path.basename(old),None) is not None:
+                        self.changed = True
+                except:
+                    print("WARNING: Unable to remove old recording segment " + old)
+
+    #Internal: Finish the current segment, noting the range of times in it so readers can skip it. The lock must be held.
+    def _endSegment(self):
+        if self.segment is not None and self.segmentrange is not None:
+            self.segments[os.path.basename(self.segment)] = self.segmentrange
+            self._writeIndex()
+        self.segment = None
+        self.segmentrange = None
+
+    #Internal: Atomically replace the index file
+    def _writeIndex(self):
+        tmp = os.path.join(self.path,"index.json.tmp")
+        with open(tmp,"w") as fl:
+            json.dump({'codes': self.codes,'names': self.names,'strings': self.strings,'segments': self.segments},fl)
+        os.replace(tmp,os.path.join(self.path,"index.json"))
+        self.changed = False
+
+#Reads data saved by a Recorder
+class Recording:
+    def __init__(self,path):
+        self.path = path
+
+    #The code, name and string tables for the recording, and the range of times in each finished segment
+    def Index(self):
+        try:
+            with open(os.path.join(self.path,"index.json"),"r") as fl:
+                index = json.load(fl)
+        except FileNotFoundError:
+            index = {}
+        return {'codes': index.get('codes',[]),'names': index.get('names',{}),'strings': index.get('strings',[]),'segments': index.get('segments',{})}
+
+    #The segment files in the recording, oldest first
+    def Segments(self):
+        try:
+            files = [x for x in os.listdir(self.path) if x.startswith("segment-") and x.endswith(".seg")]
+        except FileNotFoundError:
+            return []
+        files.sort(key=lambda x: int(x[8:-4]))
+        return [os.path.join(self.path,x) for x in files]
+
+    #Read the raw records between two UTC times, in time order
+    def Records(self,start=None,end=None):
+        columns = self._columns(start,end)
+        records = np.empty(len(columns['time']),dtype=RECORD)
+        for name in columns:
+            records[name] = columns[name]
+        return records
+
+    #Internal: Read the columns between two UTC times, in time order.
+    #Finished segments and blocks that don't overlap the range are skipped without reading their columns.
+    def _columns(self,start=None,end=None,index=None):
+        if start is not None:
+            start = int(pd.Timestamp(start).value)
+        if end is not None:
+            end = int(pd.Timestamp(end).value)
+        if index is None:
+            index = self.Index()
+
+        header = np.dtype(BLOCK)
+        parts = {name: [] for name, dtype in COLUMNS}
+        for seg in self.Segments():
+            known = index['segments'].get(os.path.basename(seg))
+            if known is not None and ((start is not None and known[1] < start) or (end is not None and known[0] > end)):
+                continue
+
+            data = np.memmap(seg,dtype=np.uint8,mode='r')
+            pos = 0
+            while pos + header.itemsize <= len(data):
+                count, first, last = data[pos:pos + header.itemsize].view(header)[0]
+                size = header.itemsize + int(count) * sum(np.dtype(x[1]).itemsize for x in COLUMNS)
+                #Ignore any partially-written block at the end of the file
+                if pos + size > len(data):
+                    break
+                if (start is None or last >= start) and (end is None or first <= end):
+                    offset = pos + header.itemsize
+                    block = {}
+                    for name, dtype in COLUMNS:
+                        width = int(count) * np.dtype(dtype).itemsize
+                        block[name] = data[offset:offset + width].view(dtype)
+                        offset += width
+                    mask = np.ones(int(count),dtype=bool)
+                    if start is not None:
+                        mask &= block['time'] >= start
+                    if end is not None:
+                        mask &= block['time'] <= end
+                    for name in block:
+                        parts[name].append(block[name][mask])
+                pos += size
+            del data
+
+        columns = {}
+        for name, dtype in COLUMNS:
+            if len(parts[name]) == 0:
+                columns[name] = np.zeros(0,dtype=dtype)
+            else:
+                columns[name] = np.concatenate(parts[name])
+        order = np.argsort(columns['time'],kind='stable')
+        return {name: columns[name][order] for name in columns}
+
+    #Load a time range into a data frame with one column per point, like AQLQuery.HistoryToDataframe.
+    #Start and end are UTC - the index is converted to localzone if given. Values are held between updates if autofill is set.
+    def Load(self,start=None,end=None,codes=None,localzone=None,autofill=True):
+        index = self.Index()
+        records = self._columns(start,end,index)
+        strings = np.array(index['strings'] + [None],dtype=object)
+
+        if codes is not None:
+            codes = set(codes)
+            wanted = [n for n, code in enumerate(index['codes']) if code in codes]
+            keep = np.isin(records['code'],wanted)
+            records = {name: records[name][keep] for name in records}
+
+        #Group the records by code in one pass - the sort is stable, so each code's values stay in time order
+        cids, inverse = np.unique(records['code'],return_inverse=True)
+        order = np.argsort(inverse,kind='stable')
+        bounds = np.searchsorted(inverse[order],np.arange(len(cids) + 1))
+
+        columns = {}
+        for n, cid in enumerate(cids):
+            rows = order[bounds[n]:bounds[n + 1]]
+            code = index['codes'][cid]
+            text = records['text'][rows]
+            values = records['value'][rows]
+            if (text >= 0).any():
+                values = values.astype(object)
+                values[text >= 0] = strings[text[text >= 0]]
+            series = pd.Series(values,index=records['time'][rows])
+            #Keep only the last value recorded at any one time
+            columns[index['names'].get(code,code)] = series[~series.index.duplicated(keep='last')]
+
+        if len(columns) == 0:
+            return pd.DataFrame()
+
+        final = pd.concat(columns,axis=1)
+        final = final.sort_index()
+        if autofill == True:
+            final = final.ffill()
+
+        dindex = pd.to_datetime(final.index,utc=True)
+        if localzone is not None:
+            dindex = dindex.tz_convert(localzone)
+        final.index = dindex.tz_localize(None)
+        return final
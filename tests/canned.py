@@ -0,0 +1,56 @@
+import datetime
+import json
+import re
+
+import ardiapi
+
+#Canned AQL history responses, shaped like the ones an ARDI server returns
+
+#A history point. Samples is a list of (time, value) - times can be datetimes or YYYY-MM-DD HH:MM:SS strings.
+def point(name,samples,prop="Value",type="MEASUREMENT",sourceid=1,propid=1,**extra):
+    history = []
+    for tm, value in samples:
+        if isinstance(tm,datetime.datetime):
+            tm = tm.strftime("%Y-%m-%d %H:%M:%S")
+        history.append([tm,str(value)])
+    record = {'name': name,'propname': prop,'type': type,'sourceid': sourceid,'propid': propid,'units': '','min': '0','max': '100','history': history}
+    if len(history) > 0:
+        record['value'] = history[-1][1]
+    record.update(extra)
+    return record
+
+#A pointlist response holding the given points
+def response(*points):
+    return {'results': [{'type': 'pointlist','value': list(points)}]}
+
+#Samples every 'step' seconds from start to end (inclusive), valued by a function of their time
+def samples(start,end,step,value=lambda tm: tm.minute):
+    out = []
+    tm = start
+    while tm <= end:
+        out.append((tm,value(tm)))
+        tm += datetime.timedelta(seconds=step)
+    return out
+
+#The start and end times a history query asks for
+def window(query):
+    found = re.search(r'"start": "([^"]+)","end": "([^"]+)"',query)
+    return (datetime.datetime.strptime(found.group(1),"%Y-%m-%d %H:%M:%S"),datetime.datetime.strptime(found.group(2),"%Y-%m-%d %H:%M:%S"))
+
+#A server object that is never connected
+def server(name="127.0.0.1"):
+    srv = ardiapi.Server(name,port=80,secure=False)
+    srv.server = name
+    return srv
+
+class FakeAQL:
+    def __init__(self):
+        self.queries = []
+        self.answer = lambda query: response()
+
+    def Execute(self,query):
+        self.queries.append(query)
+        js = self.answer(query)
+        result = ardiapi.AQLResult(js)
+        result.nbytes = len(json.dumps(js))
+        return result
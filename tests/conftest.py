@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+
+import ardiapi
+import canned
+
+#Answers AQL queries with canned responses instead of asking a server. Tests set 'answer' to a function that takes
+# the query text and returns the response JSON.
+@pytest.fixture
+def aql(monkeypatch):
+    fake = canned.FakeAQL()
+    monkeypatch.setattr(ardiapi.AQLQuery,"_execute",lambda self,query,priority=None: fake.Execute(query))
+    return fake
@@ -0,0 +1,72 @@
+import datetime
+import io
+
+import numpy as np
+import pytest
+import pytz
+
+import ardiapi
+import canned
+
+pa = pytest.importorskip("pyarrow")
+
+T0 = datetime.datetime(2024,1,1)
+
+def _response():
+    speed = [(T0 + datetime.timedelta(seconds=n * 10),v) for n, v in enumerate([10,"^",30.5,50,70])]
+    state = [(T0 + datetime.timedelta(seconds=5 + n * 15),v) for n, v in enumerate([0,1,"^",2])]
+    mode = [(T0,"Auto"),(T0 + datetime.timedelta(seconds=30),"Manual")]
+    return canned.response(canned.point("Pump",speed,prop="Speed",units="rpm"),
+                           canned.point("Pump",state,prop="State",type="STATUS",map=["Off","On","Fault"]),
+                           canned.point("Pump",mode,prop="Mode",type="TEXT"))
+
+def _compare(table,frame):
+    assert table.column_names == ['time'] + list(frame.columns)
+    assert list(table.column('time').to_numpy()) == list(frame.index.to_numpy())
+    for name in frame.columns:
+        column = table.column(name).to_pandas()
+        expected = frame[name]
+        assert list(column.isna()) == list(expected.isna())
+        good = ~expected.isna().to_numpy()
+        if expected.dtype.kind in 'if':
+            np.testing.assert_array_equal(column.to_numpy(dtype=float)[good],expected.to_numpy(dtype=float)[good])
+        else:
+            assert list(column[good]) == list(expected[good])
+
+def test_matches_the_data_frame():
+    query = ardiapi.AQLQuery(None)
+    zone = pytz.timezone("Australia/Sydney")
+    batch = query.HistoryToArrow(ardiapi.AQLResult(_response()),serverzone=zone,localzone=pytz.utc)
+    frame = query.HistoryToDataframe(ardiapi.AQLResult(_response()),serverzone=zone,localzone=pytz.utc)
+    _compare(pa.Table.from_batches([batch]),frame)
+    assert batch.schema.field('Pump Speed').metadata[b'units'] == b'rpm'
+
+def test_chunked_table_and_stream_match_the_data_frame(aql):
+    def answer(query):
+        sd, ed = canned.window(query)
+        return canned.response(canned.point("Pump",canned.samples(sd,ed,45,value=lambda tm: tm.minute),prop="Speed"))
+    aql.answer = answer
+    query = ardiapi.AQLQuery(canned.server())
+
+    def request(arrow):
+        req = ardiapi.AQLHistRequest("'Pump' ASSET VALUES {} GETHISTORY")
+        req.SetRange(T0,T0 + datetime.timedelta(hours=3),1)
+        req.Raw()
+        if arrow:
+            req.Arrow()
+        return req
+
+    table = query.GetHistory(request(True))
+    frame = query.GetHistory(request(False))
+    assert len(aql.queries) == 6
+
+    #The data frame pads each chunk out to its end - Arrow carries only the samples
+    times = table.column('time').to_numpy()
+    pads = frame.index.difference(times)
+    assert list(pads) == [T0 + datetime.timedelta(hours=h,minutes=59,seconds=59) for h in range(3)]
+    _compare(table,frame.loc[times])
+
+    sink = io.BytesIO()
+    assert query.StreamHistory(request(False),sink) == 3
+    streamed = pa.ipc.open_stream(sink.getvalue()).read_all()
+    assert streamed.equals(table)
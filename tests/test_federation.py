@@ -0,0 +1,42 @@
+import datetime
+
+import pytz
+
+import ardiapi
+import canned
+
+START = datetime.datetime(2024,1,1,0,0)
+END = datetime.datetime(2024,1,1,1,0)
+
+#Every server answers with a sample each 10 minutes across the range it was asked for, stamped in its own time
+def _answer(query):
+    sd, ed = canned.window(query)
+    return canned.response(canned.point("Level",canned.samples(sd,ed,600)))
+
+def _federate(aql,zone):
+    aql.answer = _answer
+    sydney = canned.server("sydney")
+    sydney.timezone = zone
+    req = ardiapi.AQLHistRequest("'Tank' ASSET 'Level' PROPERTY VALUES {} GETHISTORY")
+    req.SetRange(START,END)
+    return ardiapi.Federation({'sydney': sydney}).GetHistory(req)
+
+def test_pytz_server_zone(aql):
+    response = _federate(aql,pytz.timezone("Australia/Sydney"))
+    assert response.errors == {}
+    assert canned.window(aql.queries[0]) == (datetime.datetime(2024,1,1,11,0),datetime.datetime(2024,1,1,12,0))
+    frame = response.frames['sydney']
+    assert frame.index[0] == START
+    assert frame.index[-1] == END
+
+def test_servers_cover_the_same_instants(aql):
+    utc = canned.server("utc")
+    utc.timezone = pytz.utc
+    sydney = canned.server("sydney")
+    sydney.timezone = pytz.timezone("Australia/Sydney")
+    aql.answer = _answer
+    req = ardiapi.AQLHistRequest("'Tank' ASSET 'Level' PROPERTY VALUES {} GETHISTORY")
+    req.SetRange(START,END)
+    response = ardiapi.Federation({'utc': utc,'sydney': sydney}).GetHistory(req)
+    assert list(response.frames['utc'].index) == list(response.frames['sydney'].index)
+    assert list(response.frame.columns) == ['utc / Level Value','sydney / Level Value']
@@ -0,0 +1,63 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import ardiapi
+import canned
+
+T0 = datetime.datetime(2024,1,1,0,0)
+
+def _t(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+def _result(*points):
+    return ardiapi.AQLResult(canned.response(*points))
+
+def test_bad_samples_are_skipped():
+    result = _result(canned.point("Pump",[(_t(0),1),(_t(60),"^"),(_t(120),3),(_t(180),4)],prop="Speed"))
+    grid = ardiapi.GridResampler(_t(0),_t(180),30).Resample(result,autofill=True)
+    assert list(grid['Pump Speed']) == [1,1.5,2,2.5,3,3.5,4]
+
+    #The same samples through the join path
+    joined = ardiapi.AQLQuery(None).HistoryToDataframe(_result(canned.point("Pump",[(_t(0),1),(_t(60),"^"),(_t(120),3),(_t(180),4)],prop="Speed")),autofill=True)
+    assert list(grid.loc[joined.index,'Pump Speed']) == list(joined['Pump Speed'])
+
+def test_samples_on_the_grid_keep_their_value():
+    result = _result(canned.point("Pump",[(_t(0),1),(_t(60),"^"),(_t(120),3)],prop="Speed"))
+    grid = ardiapi.GridResampler(_t(0),_t(120),60).Resample(result,autofill=False)
+    assert grid['Pump Speed'].iloc[0] == 1
+    assert grid['Pump Speed'].iloc[2] == 3
+
+def test_missing_before_the_first_sample_without_autofill():
+    result = _result(canned.point("Pump",[(_t(60),1),(_t(120),3)],prop="Speed"))
+    grid = ardiapi.GridResampler(_t(0),_t(120),30).Resample(result,autofill=False)
+    assert np.isnan(grid['Pump Speed'].iloc[0])
+    assert list(grid['Pump Speed'].iloc[2:]) == [1,2,3]
+
+def test_grid_matches_the_join_path():
+    start = T0
+    end = T0 + datetime.timedelta(hours=2)
+    speed = canned.samples(start,end,70,value=lambda tm: tm.minute + tm.second / 60.0)
+    speed[5] = (speed[5][0],"^")
+    state = [(tm,n % 3) for n, (tm, value) in enumerate(canned.samples(start + datetime.timedelta(seconds=15),end,130))]
+    mode = [(tm,["Auto","Manual"][n % 2]) for n, (tm, value) in enumerate(canned.samples(start,end,900))]
+    def results():
+        return _result(canned.point("Pump",speed,prop="Speed"),
+                       canned.point("Pump",state,prop="State",type="STATUS",map=["Off","On","Fault"]),
+                       canned.point("Pump",mode,prop="Mode",type="TEXT"))
+
+    grid = ardiapi.GridResampler(start,end,60).Resample(results(),autofill=True)
+    joined = ardiapi.AQLQuery(None).HistoryToDataframe(results(),autofill=True)
+
+    #Continuous values are interpolated in time between the point's own good samples
+    good = pd.DatetimeIndex([tm for tm, value in speed if value != "^"])
+    sampled = joined.loc[good,'Pump Speed'].astype(float)
+    expected = sampled.reindex(good.union(grid.index)).interpolate(method='time').reindex(grid.index)
+    assert np.allclose(grid['Pump Speed'].to_numpy(dtype=float),expected.to_numpy(dtype=float))
+
+    #Discrete and text values are held from each sample until the next
+    for name, samples in (('Pump State',state),('Pump Mode',mode)):
+        times = pd.DatetimeIndex([tm for tm, value in samples])
+        held = joined.loc[times,name].reindex(times.union(grid.index)).ffill().bfill().reindex(grid.index)
+        assert list(grid[name]) == list(held)
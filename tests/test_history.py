@@ -0,0 +1,120 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ardiapi
+import canned
+
+T0 = datetime.datetime(2024,1,1)
+
+def _t(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+def _response():
+    speed = [(_t(n * 10),v) for n, v in enumerate([10,"^",30,50,50,"^",70,80])]
+    state = [(_t(5 + n * 15),v) for n, v in enumerate([0,1,"^",2,1])]
+    #The same time twice - the last value wins
+    level = [(_t(0),1.5),(_t(25),2.5),(_t(25),3.5),(_t(70),"^"),(_t(90),9)]
+    return canned.response(canned.point("Pump",speed,prop="Speed"),
+                           canned.point("Pump",state,prop="State",type="STATUS",map=["Off","On","Fault"]),
+                           canned.point("Tank",level,prop="Level"))
+
+#The per-column implementation HistoryToDataframe had before fill policies were applied to column blocks
+def _reference(js,namemap=None,mapbad=None,mapna=None,autofill=False,trim=None):
+    frames = []
+    interp = []
+    indx = -1
+    for r in js['results'][0]['value']:
+        indx += 1
+        interp.append('cont' if r['type'] == 'MEASUREMENT' else 'discrete')
+        sname = r['name'] + " " + r['propname']
+        if namemap is not None:
+            try:
+                sname = namemap[indx]
+            except:
+                pass
+        dindex = pd.DatetimeIndex([i[0] for i in r['history']])
+        if 'map' in r:
+            values = [None if i[1] == "^" else int(i[1]) for i in r['history']]
+        else:
+            values = [None if i[1] == "^" else float(i[1]) for i in r['history']]
+        frames.append(pd.DataFrame(values,columns=[sname],index=dindex))
+
+    final = None
+    for n in frames:
+        if mapbad is not None:
+            for x in mapbad:
+                if x[0] in n.columns:
+                    n = n.replace(x[1],np.nan)
+        if mapna is not None:
+            for x in mapna:
+                if x[0] in n.columns and x[1] not in ('hold','discrete','interp','cont'):
+                    n = n.fillna(value=x[1])
+        if final is None:
+            final = n.fillna(value=np.nan)
+        else:
+            final = final.join(n.fillna(value=np.nan),how='outer',lsuffix="",rsuffix="_dup")
+            final = final.groupby(level=0).last()
+    final = final.groupby(level=0).last()
+
+    for findex, col in enumerate(final.columns):
+        if mapna is not None:
+            for x in mapna:
+                if x[0] == str(col):
+                    if x[1] in ('hold','discrete'):
+                        final[col] = final[col].bfill().ffill()
+                    elif x[1] in ('interp','cont'):
+                        final[col] = final[col].interpolate().bfill().ffill()
+        if autofill == True:
+            if interp[findex] == 'cont':
+                final[col] = final[col].interpolate()
+            final[col] = final[col].bfill().ffill()
+
+    if trim is not None:
+        trimmed = final[trim[0]:trim[1]]
+        if len(trimmed.index) > 1:
+            if trimmed.index[0] != trim[0]:
+                trimmed = pd.concat([pd.DataFrame([final.iloc[0].values],index=pd.DatetimeIndex([trim[0]]),columns=final.columns),trimmed])
+            if trimmed.index[-1] != trim[1]:
+                trimmed = pd.concat([trimmed,pd.DataFrame([final.iloc[-1].values],index=pd.DatetimeIndex([trim[1]]),columns=final.columns)])
+            final = trimmed
+    return final
+
+CASES = [
+    {},
+    {'autofill': True},
+    {'mapbad': [['Pump Speed',50]]},
+    {'mapbad': [['Pump Speed',50],['Pump Speed',70]],'autofill': True},
+    {'mapna': [['Pump Speed','hold']]},
+    {'mapna': [['Pump State','interp'],['Tank Level','discrete']]},
+    {'mapna': [['Pump Speed',-1],['Pump State',9]]},
+    {'mapna': [['Pump Speed',-1],['Tank Level','cont']],'mapbad': [['Pump Speed',30]],'autofill': True},
+    {'namemap': ['Speed','State','Level'],'mapna': [['Level','hold']],'autofill': True},
+    {'trim': (_t(12),_t(60))},
+    {'trim': (_t(10),_t(90)),'autofill': True},
+    {'trim': (_t(31),_t(34))},
+]
+
+@pytest.mark.parametrize("options",CASES)
+def test_matches_per_column_fill(options):
+    result = ardiapi.AQLQuery(None).HistoryToDataframe(ardiapi.AQLResult(_response()),**options)
+    expected = _reference(_response(),**options)
+    assert list(result.columns) == list(expected.columns)
+    assert list(result.index) == list(expected.index)
+    for col in expected.columns:
+        np.testing.assert_array_equal(result[col].to_numpy(dtype=float),expected[col].to_numpy(dtype=float))
+
+def test_bad_values_and_duplicates():
+    result = ardiapi.AQLQuery(None).HistoryToDataframe(ardiapi.AQLResult(_response()),mapbad=[['Pump Speed',50]])
+    assert np.isnan(result.loc[_t(30),'Pump Speed'])
+    assert np.isnan(result.loc[_t(10),'Pump Speed'])
+    assert result.loc[_t(25),'Tank Level'] == 3.5
+
+def test_no_history_gives_the_point_list():
+    js = canned.response(canned.point("Pump",[],prop="Speed"))
+    del js['results'][0]['value'][0]['history']
+    result = ardiapi.AQLQuery(None).HistoryToDataframe(ardiapi.AQLResult(js))
+    assert list(result.columns) == ['Pump Speed']
+    assert len(result) == 0
@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src")
+
+#Importing the API must stay cheap - the data libraries are only loaded when they're first used
+BUDGET = 0.5
+HEAVY = ["pandas","numpy","xmltodict","pytz","dateutil.tz","pyarrow","matplotlib"]
+
+def _run(code,*flags):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = SRC + os.pathsep + env.get("PYTHONPATH","")
+    return subprocess.run([sys.executable] + list(flags) + ["-c",code],env=env,capture_output=True,text=True,check=True)
+
+def _cumulative(stderr,module):
+    for line in stderr.splitlines():
+        parts = [p.strip() for p in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000000
+    raise AssertionError("No import time reported for " + module)
+
+def test_import_within_budget():
+    result = _run("import ardiapi, aql","-X","importtime")
+    total = _cumulative(result.stderr,"ardiapi") + _cumulative(result.stderr,"aql")
+    assert total < BUDGET, "Importing ardiapi and aql took %.3fs (budget %.3fs)" % (total,BUDGET)
+
+def test_heavy_modules_not_imported():
+    result = _run("import sys, ardiapi, aql; print(','.join(m for m in %r if m in sys.modules))" % (HEAVY,))
+    assert result.stdout.strip() == ""
@@ -0,0 +1,62 @@
+import concurrent.futures
+import datetime
+import json
+import os
+
+import pytz
+
+import ardiapi
+import canned
+
+START = datetime.datetime(2024,1,1)
+END = datetime.datetime(2024,1,2)
+
+class _Response:
+    def __init__(self,js):
+        self.content = json.dumps(js).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+#A raw history response for whatever range is asked for - a bad value now and then, and a text point
+def _answer(query):
+    sd, ed = canned.window(query)
+    speed = canned.samples(sd,ed,97,value=lambda tm: "^" if tm.minute == 13 else tm.minute * 1.25)
+    state = canned.samples(sd,ed,301,value=lambda tm: tm.hour % 3)
+    mode = canned.samples(sd,ed,1800,value=lambda tm: ["Auto","Manual"][tm.hour % 2])
+    return canned.response(canned.point("Pump",speed,prop="Speed"),
+                           canned.point("Pump",state,prop="State",type="STATUS",map=["Off","On","Fault"]),
+                           canned.point("Pump",mode,prop="Mode",type="TEXT"))
+
+def _history(monkeypatch,chunks=None,processes=None):
+    monkeypatch.setattr(ardiapi.Server,"_request",lambda self,method,url,name,priority=None,**kwargs: _Response(_answer(kwargs['data']['query'])))
+    req = ardiapi.AQLHistRequest("'Pump' ASSET VALUES {} GETHISTORY")
+    req.SetRange(START,END,chunks)
+    req.Raw()
+    req.serverzone = pytz.timezone("Australia/Sydney")
+    req.localzone = pytz.utc
+    if processes is not None:
+        req.UseProcesses(processes)
+    return ardiapi.AQLQuery(canned.server()).GetHistory(req)
+
+def _blocks():
+    try:
+        return set(os.listdir("/dev/shm"))
+    except FileNotFoundError:
+        return set()
+
+def test_unchunked_matches_in_process(monkeypatch):
+    expected = _history(monkeypatch)
+    before = _blocks()
+    result = _history(monkeypatch,processes=2)
+    assert result.equals(expected)
+    assert _blocks() - before == set()
+
+def test_chunked_matches_in_process(monkeypatch):
+    expected = _history(monkeypatch,chunks=6)
+    before = _blocks()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as pool:
+        result = _history(monkeypatch,chunks=6,processes=pool)
+    assert len(result) > 1000
+    assert result.equals(expected)
+    assert _blocks() - before == set()
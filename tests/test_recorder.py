@@ -0,0 +1,63 @@
+import datetime
+import os
+
+import numpy as np
+
+import ardiapi
+
+BASE = datetime.datetime(2024,1,1)
+
+def _t(seconds):
+    return BASE + datetime.timedelta(seconds=seconds)
+
+def _record(path,count=100,**options):
+    recorder = ardiapi.Recorder(str(path),**options)
+    recorder.SetNames({'1:1:measurement': 'Pump Speed'})
+    for n in range(count):
+        recorder.Record({'1:1:measurement': str(n),'1:2:state': 'On' if n % 2 else 'Off'},_t(n))
+    recorder.Close()
+    return recorder
+
+def test_round_trip(tmp_path):
+    recorder = _record(tmp_path,flushsize=10,rotatesize=30)
+    assert recorder.written == 200
+    assert len(ardiapi.Recording(str(tmp_path)).Segments()) > 1
+
+    frame = ardiapi.Recording(str(tmp_path)).Load()
+    assert list(frame.columns) == ['Pump Speed','1:2:state']
+    assert len(frame) == 100
+    assert frame.index[0] == BASE
+    assert list(frame['Pump Speed'].iloc[:3]) == [0,1,2]
+    assert list(frame['1:2:state'].iloc[:3]) == ['Off','On','Off']
+
+def test_range_and_codes(tmp_path):
+    _record(tmp_path,flushsize=10,rotatesize=30)
+    frame = ardiapi.Recording(str(tmp_path)).Load(_t(42),_t(45),codes=['1:1:measurement'])
+    assert list(frame.columns) == ['Pump Speed']
+    assert list(frame['Pump Speed']) == [42,43,44,45]
+
+def test_finished_segments_outside_the_range_are_skipped(tmp_path):
+    _record(tmp_path,flushsize=10,rotatesize=30)
+    recording = ardiapi.Recording(str(tmp_path))
+    segments = recording.Index()['segments']
+    assert len(segments) == len(recording.Segments())
+
+    #A segment that is listed as outside the range isn't read, even if it can't be
+    first = recording.Segments()[0]
+    with open(first,"wb") as fl:
+        fl.write(b"not a segment")
+    records = recording.Records(_t(90),_t(99))
+    assert list(records['time']) == [int(np.datetime64(_t(n),'ns').astype('int64')) for n in range(90,100) for x in range(2)]
+
+def test_partial_block_is_ignored(tmp_path):
+    _record(tmp_path,count=20,flushsize=10)
+    segment = ardiapi.Recording(str(tmp_path)).Segments()[-1]
+    with open(segment,"ab") as fl:
+        fl.write(np.array([(5,0,0)],dtype=ardiapi.BLOCK).tobytes() + b"\0" * 10)
+    assert len(ardiapi.Recording(str(tmp_path)).Records()) == 40
+
+def test_keep_removes_old_segments(tmp_path):
+    _record(tmp_path,flushsize=10,rotatesize=10,keep=2)
+    recording = ardiapi.Recording(str(tmp_path))
+    assert len(recording.Segments()) == 2
+    assert sorted(recording.Index()['segments']) == sorted(os.path.basename(x) for x in recording.Segments())
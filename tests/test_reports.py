@@ -0,0 +1,50 @@
+import datetime
+
+import aql
+import canned
+
+Q = "'Tank' ASSET 'Level' PROPERTY VALUES {} GETHISTORY"
+
+#Dense data in the first report's window, a single sample in the second's, and more data after both
+def _history(start,end):
+    times = canned.samples(start,datetime.datetime(2024,1,1,1,0),300)
+    times += [(datetime.datetime(2024,1,1,2,30),230)]
+    times += canned.samples(datetime.datetime(2024,1,1,3,10),end,600)
+    return canned.response(canned.point("Tank",times,prop="Level"))
+
+def _report(args,batch):
+    return batch.History(args,Q)
+
+def test_reports_share_a_fetch_but_keep_their_own_windows(monkeypatch):
+    fetched = []
+    def query(server,qry,session=None):
+        fetched.append(qry)
+        sd, ed = canned.window(qry)
+        return _history(sd,ed)
+    monkeypatch.setattr(aql,"query",query)
+
+    batch = aql.ReportBatch(workers=2)
+    batch.Add("all",_report,["2024-01-01 00:00:00","2024-01-01 03:00:00","out","UTC","--server","ardi"],queries=[Q])
+    batch.Add("dense",_report,["2024-01-01 00:00:00","2024-01-01 01:00:00","out","UTC","--server","ardi"],queries=[Q])
+    batch.Add("sparse",_report,["2024-01-01 02:00:00","2024-01-01 03:00:00","out","UTC","--server","ardi"],queries=[Q])
+    results = batch.Run()
+
+    #One request covers all three reports
+    assert len(fetched) == 1
+    assert canned.window(fetched[0]) == (datetime.datetime(2024,1,1,0,0),datetime.datetime(2024,1,1,3,0))
+    assert batch.shared == 3
+
+    everything, error, seconds = results['all']
+    assert everything.index[0] == datetime.datetime(2024,1,1,0,0)
+    assert everything.index[-1] == datetime.datetime(2024,1,1,3,0)
+
+    dense, error, seconds = results['dense']
+    assert error is None
+    assert dense.index[0] == datetime.datetime(2024,1,1,0,0)
+    assert dense.index[-1] == datetime.datetime(2024,1,1,1,0)
+    assert len(dense.index) == 13
+
+    sparse, error, seconds = results['sparse']
+    assert error is None
+    assert list(sparse.index) == [datetime.datetime(2024,1,1,2,0),datetime.datetime(2024,1,1,2,30),datetime.datetime(2024,1,1,3,0)]
+    assert list(sparse['Tank Level']) == [0,230,230]
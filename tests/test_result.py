@@ -0,0 +1,53 @@
+import datetime
+
+import numpy as np
+
+import ardiapi
+import canned
+
+T0 = datetime.datetime(2024,1,1)
+
+def _response():
+    return canned.response(
+        canned.point("Pump",[(T0 + datetime.timedelta(seconds=n * 10),v) for n, v in enumerate([1.5,"^",3,4.25])],prop="Speed"),
+        canned.point("Pump",[(T0 + datetime.timedelta(seconds=n * 15),v) for n, v in enumerate([0,1,2])],prop="State",type="STATUS",map=["Off","On","Fault"]),
+        canned.point("Pump",[(T0,"Auto"),(T0 + datetime.timedelta(seconds=20),"Manual")],prop="Mode",type="TEXT"))
+
+def test_history_is_only_held_once():
+    result = ardiapi.AQLResult(_response())
+    for p in result.Points():
+        assert 'history' not in p.record
+        assert p.times is not None
+    for r in result.raw['results'][0]['value']:
+        assert 'history' not in r
+
+def test_json_rebuilds_the_history():
+    original = _response()
+    result = ardiapi.AQLResult(canned.response(*[dict(p) for p in original['results'][0]['value']]))
+    result.Points()
+    rebuilt = result['results'][0]['value']
+    assert rebuilt[0]['history'] == [["2024-01-01 00:00:00","1.5"],["2024-01-01 00:00:10","^"],["2024-01-01 00:00:20","3"],["2024-01-01 00:00:30","4.25"]]
+    assert rebuilt[1]['history'] == original['results'][0]['value'][1]['history']
+    assert rebuilt[2]['history'] == original['results'][0]['value'][2]['history']
+
+def test_shared_result_gives_the_same_frames():
+    query = ardiapi.AQLQuery(None)
+    shared = ardiapi.AQLResult(_response())
+    first = query.HistoryToDataframe(shared,autofill=True)
+    second = query.HistoryToDataframe(shared,autofill=True)
+    fresh = query.HistoryToDataframe(_response(),autofill=True)
+    assert first.equals(second)
+    assert first.equals(fresh)
+    assert list(first.columns) == ['Pump Speed','Pump State','Pump Mode']
+    assert first['Pump Speed'].iloc[0] == 1.5
+    assert not np.isnan(first['Pump Speed']).any()
+
+def test_cached_execute_keeps_the_history(aql):
+    aql.answer = lambda query: _response()
+    server = canned.server()
+    server.EnableCache()
+    query = ardiapi.AQLQuery(server)
+    query.HistoryToDataframe(query.Query("'Pump' ASSET VALUES"))
+    js = query.Execute("'Pump' ASSET VALUES")
+    assert len(aql.queries) == 1
+    assert len(js['results'][0]['value'][0]['history']) == 4
@@ -0,0 +1,13 @@
+import os
+import sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","tools"))
+
+import ardisoak
+
+#A short run of the live data soak test, with a fifth of the consolidator requests failing
+def test_soak_survives_faults():
+    test = ardisoak.SoakTest(codes=1000,rate=1000,faults=0.2,duration=3,interval=0.5,warmup=1)
+    test.Run()
+    assert test.Check() == []
+    assert test.samples[-1]['faults'] > 0
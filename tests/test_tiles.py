@@ -0,0 +1,39 @@
+import datetime
+
+import pandas as pd
+import pytest
+import pytz
+
+import ardiapi
+import canned
+
+SPAN = 60 * 4 * 1000000000
+
+def _now(zone):
+    return pd.Timestamp.now(tz=zone).tz_localize(None).value
+
+#Tile times are in the server's timezone, so only tiles that have finished in that zone are kept.
+#With the server ten hours behind UTC every tile would look finished, and ten hours ahead, none would.
+@pytest.mark.parametrize("zone",["Etc/GMT+10","Etc/GMT-10"])
+def test_only_finished_tiles_are_kept(aql,zone):
+    aql.answer = lambda query: canned.response(canned.point("Pump",canned.samples(*canned.window(query),30,value=lambda tm: tm.minute)))
+    srv = canned.server()
+    srv.timezone = pytz.timezone(zone)
+    tiles = ardiapi.TileCache(srv,base=60,tilesize=4)
+
+    before = _now(srv.timezone)
+    start = pd.Timestamp(before) - pd.Timedelta(minutes=20)
+    frame = tiles.View("'Pump' ASSET VALUES {} GETHISTORY",start,start + pd.Timedelta(minutes=30))
+    after = _now(srv.timezone)
+
+    assert len(frame.index) > 0
+    assert len(aql.queries) == 1
+    kept = [key[2] for key in tiles.tiles]
+    assert len(kept) >= 4
+    assert all((n + 1) * SPAN <= after for n in kept)
+    assert after // SPAN not in kept
+    assert before // SPAN - 1 in kept
+
+def test_unknown_zone_is_utc():
+    tiles = ardiapi.TileCache(canned.server())
+    assert abs(tiles._now().value - _now(pytz.utc)) < 60 * 1000000000
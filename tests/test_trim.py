@@ -0,0 +1,61 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import aql
+from ardiapi import TrimFrame
+
+def _t(minute):
+    return datetime.datetime(2024,1,1,0,0) + datetime.timedelta(minutes=minute)
+
+#Samples at 00:00, 00:10 ... 00:40 - the value is the minute
+def _frame(minutes=(0,10,20,30,40)):
+    return pd.DataFrame({'A': [float(m) for m in minutes],'B': [float(m) * 10 for m in minutes]},index=pd.DatetimeIndex([_t(m) for m in minutes]))
+
+def test_hold_pads_both_ends():
+    result = aql.TrimDataFrame(_frame(),_t(5),_t(35))
+    assert list(result.index) == [_t(5),_t(10),_t(20),_t(30),_t(35)]
+    #The start holds the value before the window, the end takes the next row
+    assert list(result['A']) == [0,10,20,30,40]
+
+def test_hold_single_row_window():
+    result = aql.TrimDataFrame(_frame(),_t(15),_t(25))
+    assert list(result.index) == [_t(15),_t(20),_t(25)]
+    assert list(result['A']) == [10,20,30]
+
+def test_hold_empty_window():
+    result = aql.TrimDataFrame(_frame(),_t(12),_t(18))
+    assert list(result.index) == [_t(12),_t(18)]
+    assert list(result['A']) == [10,20]
+
+def test_hold_exact_boundaries():
+    result = aql.TrimDataFrame(_frame(),_t(10),_t(30))
+    assert list(result.index) == [_t(10),_t(20),_t(30)]
+    assert list(result['B']) == [100,200,300]
+
+def test_hold_window_before_data():
+    result = aql.TrimDataFrame(_frame((20,30)),_t(0),_t(10))
+    assert list(result.index) == [_t(0),_t(10)]
+
+def test_hold_fills_gaps_from_earlier_rows():
+    frame = _frame()
+    frame.loc[_t(0),'B'] = -1
+    frame.loc[_t(10),'B'] = np.nan
+    result = TrimFrame(frame,_t(15),_t(25),hold=True)
+    assert result['B'].iloc[0] == -1
+
+def test_history_pads_from_frame_ends():
+    result = TrimFrame(_frame(),_t(5),_t(35))
+    assert list(result.index) == [_t(5),_t(10),_t(20),_t(30),_t(35)]
+    assert list(result['A']) == [0,10,20,30,40]
+
+def test_history_sparse_window_is_untouched():
+    frame = _frame()
+    assert TrimFrame(frame,_t(15),_t(25)) is frame
+    assert TrimFrame(frame,_t(12),_t(18)) is frame
+
+def test_unsorted_and_duplicate_index():
+    frame = _frame((30,10,10,20))
+    result = aql.TrimDataFrame(frame,_t(10),_t(30))
+    assert list(result.index) == [_t(10),_t(20),_t(30)]
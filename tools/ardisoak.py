@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","src"))
+import ardiapi
+
+#Soak test for live data - drives a Session against a simulated consolidator for a period of time, recording memory,
+# callback latency and reconnections, and fails if any of them pass their thresholds.
+#
+#   python tools/ardisoak.py --codes 100000 --rate 5000 --duration 3600 --faults 0.01 --csv soak.csv
+
+#A consolidator that serves live data for any number of codes. Every value is the time it was generated, so the
+# receiver can measure latency. Faults (dropped connections, bad responses and forgotten subscriptions) are
+# injected at random.
+class SimulatedConsolidator:
+    def __init__(self,rate=1000,faults=0.0,poll=1.0):
+        #Values generated per second, across all subscribed codes
+        self.rate = rate
+
+        #The chance of each request failing
+        self.faults = faults
+
+        #The longest an update call waits for data
+        self.poll = poll
+
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.nextid = 1
+        self.random = random.Random(1)
+        self.counts = {'subscribe': 0,'update': 0,'unsubscribe': 0,'query': 0,'faults': 0,'values': 0}
+        self.server = None
+
+    #Start serving on a free port, returning the port
+    def Start(self):
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self,*args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length',0))
+                fields = urllib.parse.parse_qs(self.rfile.read(length).decode())
+                sim._handle(self,self.path,fields)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1',0),Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        return self.server.server_address[1]
+
+    #Stop serving
+    def Stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    #A copy of the request, fault and value counters
+    def Counts(self):
+        with self.lock:
+            return dict(self.counts)
+
+    #Internal: Handle a single request
+    def _handle(self,handler,path,fields):
+        function = path.split("/")[-1]
+        kind = None
+        with self.lock:
+            if function in self.counts:
+                self.counts[function] += 1
+            if self.random.random() < self.faults:
+                self.counts['faults'] += 1
+                kind = self.random.choice(['drop','garbage','forget'])
+
+        if kind is not None:
+            if kind == 'drop':
+                handler.close_connection = True
+                return
+            if kind == 'garbage':
+                return self._send(handler,"Internal Error","text/plain")
+            with self.lock:
+                self.subscriptions.clear()
+
+        if function == 'query':
+            #History for backfill - the soak test only needs the request to succeed
+            return self._send(handler,json.dumps({'results': [{'type': 'pointlist','value': []}]}))
+
+        if function == 'subscribe':
+            codes = [c for c in fields.get('codes',[''])[0].split(",") if c != ""]
+            with self.lock:
+                subid = str(self.nextid)
+                self.nextid += 1
+                self.subscriptions[subid] = [codes,time.time()]
+                self.counts['values'] += len(codes)
+            now = "%.6f" % time.time()
+            return self._send(handler,json.dumps({'id': subid,'items': [{'code': c,'value': now} for c in codes],'messages': []}))
+
+        subid = fields.get('id',[''])[0]
+        if function == 'unsubscribe':
+            with self.lock:
+                self.subscriptions.pop(subid,None)
+            return self._send(handler,json.dumps({'id': subid,'items': [],'messages': []}))
+
+        with self.lock:
+            sub = self.subscriptions.get(subid)
+        if sub is None:
+            #The consolidator doesn't know this subscription (ie. it has restarted)
+            return self._send(handler,"Unknown subscription","text/plain")
+
+        #Wait long enough for at least one value, up to the poll time
+        codes, last = sub
+        wait = min(self.poll,max(0,(1.0 / max(self.rate,1)) - (time.time() - last)))
+        time.sleep(wait)
+        now = time.time()
+        count = min(len(codes),int((now - last) * self.rate))
+        sub[1] = now
+        stamp = "%.6f" % now
+        with self.lock:
+            picked = self.random.sample(codes,count)
+            self.counts['values'] += count
+        items = [{'code': c,'value': stamp} for c in picked]
+        return self._send(handler,json.dumps({'id': subid,'items': items,'messages': []}))
+
+    #Internal: Send a response
+    def _send(self,handler,body,ctype="application/json"):
+        data = body.encode()
+        handler.send_response(200)
+        handler.send_header('Content-Type',ctype)
+        handler.send_header('Content-Length',str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+#Runs a Session against a consolidator and samples its health over time
+class SoakTest:
+    def __init__(self,codes=1000,rate=1000,faults=0.0,duration=60,interval=5,warmup=10):
+        self.codes = codes
+        self.rate = rate
+        self.faults = faults
+        self.duration = duration
+        self.interval = interval
+        self.warmup = warmup
+
+        #Pass/fail thresholds (None to ignore)
+        self.maxrss = None
+        self.maxblocks = None
+        self.maxp99 = None
+        self.maxresubscribes = None
+
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.samples = []
+        self.session = None
+
+    #Run the test, returning the list of samples
+    def Run(self,csv=None):
+        sim = SimulatedConsolidator(rate=self.rate,faults=self.faults)
+        port = sim.Start()
+
+        server = ardiapi.Server('127.0.0.1',port=port,secure=False)
+        server.prefix = "http://"
+        server.server = "127.0.0.1"
+        server.webport = port
+        context = ardiapi.Context()
+        context.consolidator = port
+        server.contexts = [context]
+
+        self.session = ardiapi.Session(server)
+        for n in range(0,self.codes):
+            chan = ardiapi.Channel(self.session)
+            chan.name = "Soak " + str(n)
+            chan.code = str(n) + ":1:measurement"
+            chan.type = "MEASUREMENT"
+            self.session.channels.append(chan)
+        self.session.Callback(self._updated)
+
+        tracemalloc.start()
+        thread = threading.Thread(target=self.session.Start,daemon=True)
+        thread.start()
+
+        out = None
+        if csv is not None:
+            out = open(csv,"w")
+            out.write("elapsed,rss,blocks,traced,peak,values,p50,p90,p99,max,resubscribes,failures,faults\n")
+
+        start = time.time()
+        try:
+            while time.time() - start < self.duration:
+                time.sleep(self.interval)
+                sample = self._sample(time.time() - start,sim)
+                self.samples.append(sample)
+                print(self._format(sample))
+                if out is not None:
+                    out.write(",".join(str(sample[k]) for k in ['elapsed','rss','blocks','traced','peak','values','p50','p90','p99','max','resubscribes','failures','faults']) + "\n")
+                    out.flush()
+        finally:
+            self.session.Stop()
+            thread.join(10)
+            sim.Stop()
+            tracemalloc.stop()
+            if out is not None:
+                out.close()
+
+        return self.samples
+
+    #Check the samples against the thresholds, returning a list of failures (empty if the test passed)
+    def Check(self):
+        failures = []
+        steady = [s for s in self.samples if s['elapsed'] >= self.warmup]
+        if len(steady) < 2:
+            return ["Not enough samples after the warm-up period"]
+        first = steady[0]
+        last = steady[-1]
+
+        growth = (last['rss'] - first['rss']) / (1024 * 1024)
+        if self.maxrss is not None and growth > self.maxrss:
+            failures.append("RSS grew by %.1f MB (limit %.1f MB)" % (growth,self.maxrss))
+
+        blocks = last['blocks'] - first['blocks']
+        if self.maxblocks is not None and blocks > self.maxblocks:
+            failures.append("Allocated blocks grew by %d (limit %d)" % (blocks,self.maxblocks))
+
+        worst = max(s['p99'] for s in steady)
+        if self.maxp99 is not None and worst > self.maxp99:
+            failures.append("p99 callback latency reached %.1f ms (limit %.1f ms)" % (worst,self.maxp99))
+
+        if self.maxresubscribes is not None and last['resubscribes'] > self.maxresubscribes:
+            failures.append("%d resubscribes (limit %d)" % (last['resubscribes'],self.maxresubscribes))
+
+        if last['values'] == 0:
+            failures.append("No values were delivered")
+        return failures
+
+    #Internal: Session callback - records the latency of every value
+    def _updated(self,channels):
+        now = time.time()
+        latencies = []
+        for chan in channels:
+            try:
+                latencies.append(now - float(chan.value))
+            except:
+                pass
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.delivered += len(channels)
+
+    #Internal: Take a sample of memory, latency and reconnection counts
+    def _sample(self,elapsed,sim):
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+            delivered = self.delivered
+
+        latencies.sort()
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0
+            return latencies[min(len(latencies) - 1,int(len(latencies) * p))] * 1000
+
+        traced, peak = tracemalloc.get_traced_memory()
+        subscription = self.session.subscription
+        return { 'elapsed': round(elapsed,1),'rss': _rss(),'blocks': sys.getallocatedblocks(),'traced': traced,'peak': peak,
+                 'values': delivered,'p50': percentile(0.5),'p90': percentile(0.9),'p99': percentile(0.99),'max': percentile(1),
+                 'resubscribes': subscription.resubscribes if subscription is not None else 0,
+                 'failures': subscription.failures if subscription is not None else 0,
+                 'faults': sim.Counts()['faults'] }
+
+    #Internal: A sample as a line of text
+    def _format(self,s):
+        return "%7.1fs  rss %7.1f MB  blocks %9d  traced %7.1f MB  values %9d  latency p50 %7.1f p99 %7.1f max %7.1f ms  resubscribes %4d  faults %4d" % (
+            s['elapsed'],s['rss'] / (1024 * 1024),s['blocks'],s['traced'] / (1024 * 1024),s['values'],s['p50'],s['p99'],s['max'],s['resubscribes'],s['faults'])
+
+#Internal: The resident set size of this process in bytes
+def _rss():
+    try:
+        with open("/proc/self/statm","r") as fl:
+            return int(fl.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return usage
+        return usage * 1024
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Soak test ARDI live data subscriptions")
+    parser.add_argument('--codes',type=int,default=1000,help='The number of points to subscribe to')
+    parser.add_argument('--rate',type=float,default=1000,help='Values generated per second')
+    parser.add_argument('--faults',type=float,default=0.0,help='The chance (0-1) of each consolidator request failing')
+    parser.add_argument('--duration',type=float,default=60,help='How long to run, in seconds')
+    parser.add_argument('--interval',type=float,default=5,help='Seconds between samples')
+    parser.add_argument('--warmup',type=float,default=10,help='Seconds to ignore before checking thresholds')
+    parser.add_argument('--csv',default=None,help='Write the samples to this file')
+    parser.add_argument('--max-rss',dest='maxrss',type=float,default=None,help='Maximum RSS growth after warm-up, in MB')
+    parser.add_argument('--max-blocks',dest='maxblocks',type=int,default=None,help='Maximum growth in allocated blocks after warm-up')
+    parser.add_argument('--max-p99',dest='maxp99',type=float,default=None,help='Maximum p99 callback latency, in ms')
+    parser.add_argument('--max-resubscribes',dest='maxresubscribes',type=int,default=None,help='Maximum number of resubscribes')
+    args = parser.parse_args()
+
+    test = SoakTest(codes=args.codes,rate=args.rate,faults=args.faults,duration=args.duration,interval=args.interval,warmup=args.warmup)
+    test.maxrss = args.maxrss
+    test.maxblocks = args.maxblocks
+    test.maxp99 = args.maxp99
+    test.maxresubscribes = args.maxresubscribes
+    test.Run(args.csv)
+
+    failures = test.Check()
+    if len(failures) == 0:
+        print("PASSED")
+        sys.exit(0)
+    for f in failures:
+        print("FAILED: " + f)
+    sys.exit(1)